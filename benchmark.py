@@ -0,0 +1,276 @@
+"""Latency and throughput benchmark for the laser server.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## This script starts a laser_server.Server against simulated serial devices
+# and drives it with concurrent Pyro clients. It reports per-method and
+# per-laser latency percentiles and throughput, and can save the results as
+# JSON and compare them with a previous run, e.g.
+#   python benchmark.py --lasers deepstar488,cobolt561 -o run.json
+#   python benchmark.py -o new.json --compare run.json
+#   python benchmark.py --sim realtime=0 --serializers pickle,marshal
+import ConfigParser
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+import Pyro4
+
+import laser_server
+
+## Methods called by each client, as (name, args).
+METHODS = [('getPower_mW', ()),
+           ('setPower_mW', (10,)),
+           ('getStatus', ())]
+## Methods called on the laserServer group object, as (name, args).
+GROUP_METHODS = [('getPowerStates', ())]
+
+
+## Return the pth percentile of a sorted list by nearest rank.
+def percentile(values, p):
+    if not values:
+        return None
+    index = int(round(p / 100. * (len(values) - 1)))
+    return values[index]
+
+
+## Return a free TCP port on host.
+def freePort(host):
+    s = socket.socket()
+    s.bind((host, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+## Build a server config for simulated lasers.
+# lasers is a list of section names, e.g. ['deepstar488', 'cobolt561'];
+# simOptions is appended to each sim:// URL as a query string.
+def makeConfig(lasers, host, port, simOptions='', pollInterval=None,
+               serializer=None):
+    config = ConfigParser.SafeConfigParser()
+    modules = sorted(set(name.rstrip('0123456789') for name in lasers))
+    config.add_section(laser_server.CONFIG_NAME)
+    config.set(laser_server.CONFIG_NAME, 'supported', ' '.join(modules))
+    config.set(laser_server.CONFIG_NAME, 'ipAddress', host)
+    config.set(laser_server.CONFIG_NAME, 'port', str(port))
+    if serializer:
+        config.set(laser_server.CONFIG_NAME, 'serializer', serializer)
+    for name in lasers:
+        module = name.rstrip('0123456789')
+        url = 'sim://%s' % module
+        if simOptions:
+            url += '?' + simOptions
+        config.add_section(name)
+        config.set(name, 'comPort', url)
+        config.set(name, 'baud', '115200' if module == 'cobolt' else '9600')
+        config.set(name, 'timeout', '1')
+        if pollInterval:
+            config.set(name, 'pollInterval', str(pollInterval))
+    return config
+
+
+## A client thread calling one method on one laser until stopped.
+class Client(threading.Thread):
+    def __init__(self, uri, method, args, stop):
+        super(Client, self).__init__()
+        self.daemon = True
+        self.uri = uri
+        self.method = method
+        self.args = args
+        self.stop = stop
+        self.latencies = []
+        self.errors = 0
+
+
+    def run(self):
+        proxy = Pyro4.Proxy(self.uri)
+        call = getattr(proxy, self.method)
+        while not self.stop.is_set():
+            t0 = time.time()
+            try:
+                call(*self.args)
+            except Exception:
+                self.errors += 1
+                continue
+            self.latencies.append(time.time() - t0)
+        proxy._pyroRelease()
+
+
+## Run clients against every laser and method, and against the group
+# object; return a results dict. Clients use serializer, or pickle if None.
+def runBenchmark(lasers, clientsPerMethod=1, duration=5., simOptions='',
+                 pollInterval=None, host='127.0.0.1', serializer=None):
+    port = freePort(host)
+    config = makeConfig(lasers, host, port, simOptions, pollInterval,
+                        serializer)
+    Pyro4.config.SERIALIZER = serializer or 'pickle'
+    server = laser_server.Server(config)
+    serverThread = threading.Thread(target=server.run)
+    serverThread.start()
+    server.ready.wait()
+    try:
+        stop = threading.Event()
+        clients = []
+        for name in lasers:
+            uri = 'PYRO:%s@%s:%d' % (name, host, port)
+            for method, args in METHODS:
+                for i in xrange(clientsPerMethod):
+                    clients.append((name, method,
+                                    Client(uri, method, args, stop)))
+        uri = 'PYRO:%s@%s:%d' % (laser_server.CONFIG_NAME, host, port)
+        for method, args in GROUP_METHODS:
+            for i in xrange(clientsPerMethod):
+                clients.append((laser_server.CONFIG_NAME, method,
+                                Client(uri, method, args, stop)))
+        t0 = time.time()
+        for name, method, client in clients:
+            client.start()
+        time.sleep(duration)
+        stop.set()
+        for name, method, client in clients:
+            client.join()
+        elapsed = time.time() - t0
+    finally:
+        server.stop()
+        serverThread.join()
+
+    results = {}
+    for name, method, client in clients:
+        entry = results.setdefault(name, {}).setdefault(
+                method, {'latencies': [], 'errors': 0})
+        entry['latencies'].extend(client.latencies)
+        entry['errors'] += client.errors
+    for name, methods in results.iteritems():
+        for method, entry in methods.iteritems():
+            latencies = sorted(entry.pop('latencies'))
+            entry['calls'] = len(latencies)
+            entry['ops_per_s'] = len(latencies) / elapsed
+            entry['p50_ms'] = 1000 * percentile(latencies, 50) if latencies else None
+            entry['p99_ms'] = 1000 * percentile(latencies, 99) if latencies else None
+    totalCalls = sum(entry['calls'] for methods in results.itervalues()
+                     for entry in methods.itervalues())
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'pyro': Pyro4.__version__,
+            'serializer': Pyro4.config.SERIALIZER,
+            'lasers': lasers,
+            'clientsPerMethod': clientsPerMethod,
+            'duration': elapsed,
+            'simOptions': simOptions,
+            'pollInterval': pollInterval,
+            'ops_per_s': totalCalls / elapsed,
+            'results': results}
+
+
+## Print a results table.
+def report(run):
+    print "%s: %d clients/method, %.1f s, %.1f ops/s total" % (
+            run['serializer'], run['clientsPerMethod'], run['duration'],
+            run['ops_per_s'])
+    print "%-14s %-14s %8s %9s %9s %9s %6s" % (
+            'laser', 'method', 'calls', 'ops/s', 'p50 ms', 'p99 ms', 'errors')
+    for name in sorted(run['results']):
+        for method in sorted(run['results'][name]):
+            entry = run['results'][name][method]
+            print "%-14s %-14s %8d %9.1f %9s %9s %6d" % (
+                    name, method, entry['calls'], entry['ops_per_s'],
+                    '%.2f' % entry['p50_ms'] if entry['calls'] else '-',
+                    '%.2f' % entry['p99_ms'] if entry['calls'] else '-',
+                    entry['errors'])
+
+
+## Print the change in p50 latency per call for each method, from the first
+# run (e.g. with pickle) to each of the others.
+def reportSerializers(runs):
+    base = runs[0]
+    print "%-14s %-14s %10s" % ('laser', 'method', 'p50 ms') + ''.join(
+            " %16s" % run['serializer'] for run in runs[1:])
+    for name in sorted(base['results']):
+        for method in sorted(base['results'][name]):
+            old = base['results'][name][method]['p50_ms']
+            line = "%-14s %-14s %10s" % (name, method,
+                                         '-' if old is None else '%.3f' % old)
+            for run in runs[1:]:
+                new = run['results'].get(name, {}).get(method, {}).get('p50_ms')
+                if old is None or new is None:
+                    line += " %16s" % '-'
+                else:
+                    line += " %8.3f (%+4.0f%%)" % (new, 100 * (new - old) / old)
+            print line
+
+
+## Compare a run with a baseline. Return a list of regressions, where p99
+# latency grew or throughput fell by more than tolerance (a fraction).
+def compare(run, baseline, tolerance=0.2):
+    regressions = []
+    for name, methods in run['results'].iteritems():
+        for method, entry in methods.iteritems():
+            try:
+                old = baseline['results'][name][method]
+            except KeyError:
+                continue
+            if not (entry['calls'] and old['calls']):
+                continue
+            if entry['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+                regressions.append('%s.%s p99 %.2f ms -> %.2f ms' % (
+                        name, method, old['p99_ms'], entry['p99_ms']))
+            if entry['ops_per_s'] < old['ops_per_s'] * (1 - tolerance):
+                regressions.append('%s.%s %.1f ops/s -> %.1f ops/s' % (
+                        name, method, old['ops_per_s'], entry['ops_per_s']))
+    return regressions
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-l", "--lasers", dest="lasers", default="deepstar488,cobolt561", help="comma-separated laser sections to simulate", metavar="SECTIONS")
+    parser.add_option("-c", "--clients", type="int", dest="clients", default=1, help="concurrent clients per method per laser", metavar="N")
+    parser.add_option("-d", "--duration", type="float", dest="duration", default=5., help="duration of the run in seconds", metavar="SECONDS")
+    parser.add_option("-s", "--sim", dest="sim_options", default="", help="simulator options, e.g. junk=0.1&delay=0.002", metavar="OPTIONS")
+    parser.add_option("-p", "--poll", type="float", dest="poll_interval", default=None, help="enable the status poller with this interval", metavar="SECONDS")
+    parser.add_option("--serializers", dest="serializers", default="pickle", help="comma-separated Pyro serializers; with more than one, run each and compare with the first", metavar="NAMES")
+    parser.add_option("-o", "--output", dest="output", default=None, help="save results as JSON to this file", metavar="FILE")
+    parser.add_option("--compare", dest="baseline", default=None, help="compare with results saved from a previous run", metavar="FILE")
+    parser.add_option("--tolerance", type="float", dest="tolerance", default=0.2, help="fractional change counted as a regression", metavar="FRACTION")
+    (options, args) = parser.parse_args()
+
+    runs = []
+    for serializer in options.serializers.split(','):
+        runs.append(runBenchmark(options.lasers.split(','), options.clients,
+                                 options.duration, options.sim_options,
+                                 options.poll_interval, serializer=serializer))
+        report(runs[-1])
+    if len(runs) > 1:
+        reportSerializers(runs)
+    run = runs[0]
+    if options.output:
+        with open(options.output, 'w') as fh:
+            json.dump(run, fh, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as fh:
+            regressions = compare(run, json.load(fh), options.tolerance)
+        for regression in regressions:
+            print "REGRESSION:", regression
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,49 +15,70 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import Pyro4
-import serial
 import socket
-import threading
-import time
 import laser
-import functools
+import protocol
+import transport
 
 CONFIG_NAME = 'cobolt'
 CLASS_NAME = 'CoboltLaser'
 
-def lockComms(func):
-    """A decorator to flush the input buffer prior to issuing a command.
-
-    Locks the comms channel so that a function must finish all its comms
-    before another can run.
-    """
-    @functools.wraps(func)
-    def wrapper(self, *args, **kwargs):
-        with self.commsLock:
-            return func(self, *args, **kwargs)
-
-    return wrapper
+## Cobolt powers are in W on the wire and in mW in the Laser API.
+def _fromWatts(response):
+    return 1000 * float(response)
+
+def _toWatts(mW):
+    return mW / 1000.
+
+## The Cobolt protocol; see protocol.Command.
+PROTOCOL = {
+    'serialNumber': protocol.Command('sn?'),
+    # Maximum laser power in mW.
+    'maxPower': protocol.Command('gmlp?', protocol.FLOAT, float),
+    'firmware': protocol.Command('gfv?'),
+    # 0 disables autostart, so that emission can be switched remotely.
+    'autostart': protocol.Command('@cobas %d'),
+    'directControl': protocol.Command('@cobasdr %d'),
+    # Laser on/off after the interlock, in autostart mode.
+    'laserOn': protocol.Command('@cob%d'),
+    'emission': protocol.Command('l%d'),
+    'isOn': protocol.Command('l?', protocol.BIT, lambda r: r == '1'),
+    'setPower': protocol.Command('@cobasp %.4f', encode=_toWatts),
+    'targetPower': protocol.Command('p?', protocol.FLOAT, _fromWatts),
+    'power': protocol.Command('pa?', protocol.FLOAT, _fromWatts),
+    'fault': protocol.Command('f?', protocol.INT, int),
+    'clearFault': protocol.Command('cf'),
+    'hours': protocol.Command('hrs?', protocol.FLOAT, float),
+    }
+
+## Encodes commands with their CR/LF terminator.
+ENCODER = protocol.Encoder(lambda command: command + '\r\n', PROTOCOL)
 
 
 class CoboltLaser(laser.Laser):
+    # Cobolt heads are documented to buffer incoming commands and reply in
+    # order, so they can be pipelined (see laser.Laser.canPipeline).
+    protocol = PROTOCOL
+
     def __init__(self, serialPort, baudRate, timeout):
-        super(CoboltLaser, self).__init__()
+        super(CoboltLaser, self).__init__(serialPort, baudRate, timeout)
         print "Connecting to laser on port",serialPort,"with rate",baudRate,"and timeout",timeout
-        self.connection = serial.Serial(port = serialPort,
-            baudrate = baudRate, timeout = timeout,
-            stopbits = serial.STOPBITS_ONE,
-            bytesize = serial.EIGHTBITS, parity = serial.PARITY_NONE)
+        self.connection = transport.openPort(serialPort, baudRate, timeout)
         # Start a logger.
         self.logger = laser.LaserLogger()
         self.logger.open(CLASS_NAME + '_' + serialPort)
-        self.write('sn?')
-        response = self.readline()
-        self.logger.log("Cobolt laser serial number: [%s]" % response)
+        self._handshake()
+
+
+    ## Commands to run each time the port is opened.
+    def _handshake(self):
+        self.refreshConstants()
+        self.logger.log("Cobolt laser serial number: [%s]" %
+                        self.constants['serialNumber'])
         # We need to ensure that autostart is disabled so that we can switch emission
         # on/off remotely.
-        self.write('@cobas 0')
-        self.logger.log("Response to @cobas 0 [%s]" % self.readline())
-        self.commsLock = threading.RLock()
+        self.logger.log("Response to @cobas 0 [%s]" %
+                        self.command('autostart', 0))
 
 
     ## Simple passthrough.
@@ -67,12 +88,28 @@ class CoboltLaser(laser.Laser):
 
     ## Simple passthrough.
     def readline(self):
-        return self.connection.readline().strip()
+        self.applyDeadline()
+        line = self.connection.readline()
+        self.noteResponse(line)
+        return line.strip()
+
+
+    ## Discard responses owed to transactions that were cut short, and
+    # anything else received but not read. Cobolt heads reply in order, so
+    # a late response would otherwise be taken as the answer to our command.
+    def discardInput(self):
+        self.discardStaleResponses(
+                lambda: self.connection.readline().endswith('\n'))
+        self.connection.flushInput()
 
 
     ## Send a command. 
     def write(self, command):
-        response = self.connection.write(command + '\r\n')
+        if not self.pendingCommands:
+            # Nothing is awaited, so anything unread is stale.
+            self.discardInput()
+        response = self.connection.write(ENCODER.encode(command))
+        self.noteWrite(command)
         return response
 
 
@@ -82,116 +119,145 @@ class CoboltLaser(laser.Laser):
         return self.readline()
 
 
-    @lockComms
+    @laser.lockComms
+    def _readConstants(self):
+        serialNumber, maxPower, firmware = self.commandMany(
+                ['serialNumber', 'maxPower', 'firmware'])
+        return {'serialNumber': serialNumber,
+                'maxPower_mW': maxPower,
+                'firmware': firmware}
+
+
+    @laser.invalidatesCache()
+    @laser.lockComms
     def clearFault(self):
-        self.write('cf')
-        self.readline()
+        self.command('clearFault')
+        self.invalidateConstants()
         return self.getStatus()
 
 
     def flushBuffer(self):
+        # Read from the connection directly: the final, empty read is
+        # expected and should not count as a timeout.
         line = ' '
         while len(line) > 0:
-            line = self.readline()
+            line = self.connection.readline()
 
-    @lockComms
+    @laser.lockComms
     def isAlive(self):
-        self.write('l?')
-        response = self.readline()
-        return response in '01'
+        try:
+            self.command('isOn')
+        except protocol.ProtocolError:
+            return False
+        return True
 
 
-    @lockComms
+    @laser.cachedQuery('status')
+    @laser.lockComms
     def getStatus(self):
-        result = []
-        for cmd, stat in [('l?', 'Emission on?'),
-                            ('p?', 'Target power:'),
-                            ('pa?', 'Measured power:'),
-                            ('f?', 'Fault?'),
-                            ('hrs?', 'Head operating hours:')]:
-            self.write(cmd)
-            result.append(stat + ' ' + self.readline())
-        return result
+        cmds, stats = zip(('isOn', 'Emission on?'),
+                          ('targetPower', 'Target power:'),
+                          ('power', 'Measured power:'),
+                          ('fault', 'Fault?'),
+                          ('hours', 'Head operating hours:'))
+        responses = self.commandMany(cmds, convert=False)
+        return [stat + ' ' + response
+                for stat, response in zip(stats, responses)]
 
 
     ## Things that should be done when cockpit exits.
-    @lockComms
+    @laser.invalidatesCache()
+    @laser.lockComms
+    @laser.priority(laser.URGENT)
     def onExit(self):
         # Disable laser.
-        self.send('l0')
-        self.send('@cob0')
+        self.commandMany([('emission', 0), ('laserOn', 0)])
         self.flushBuffer()
 
 
     ##  Initialization to do when cockpit connects.
-    @lockComms
+    @laser.invalidatesCache()
+    @laser.lockComms
     def onCockpitInitialize(self):
         self.flushBuffer()
         #We don't want 'direct control' mode.
-        self.send('@cobasdr 0')
         # Force laser into autostart mode.
-        self.send('@cob1')
+        self.commandMany([('directControl', 0), ('laserOn', 1)])
 
 
     ## Turn the laser ON. Return True if we succeeded, False otherwise.
-    @lockComms
+    @laser.invalidatesCache('isOn', 'power', 'status', 'fault')
+    @laser.lockComms
     def enable(self):
-        self.logger.log("Turning laser ON at %s" % time.strftime('%Y-%m-%d %H:%M:%S'))
-        # Turn on emission.
-        response = self.send('l1')
+        self.logger.log("Turning laser ON.")
+        # Turn on emission and check that it took.
+        response, isOn = self.commandMany([('emission', 1), 'isOn'])
         self.logger.log("l1: [%s]" % response)
 
-        if not self.getIsOn():
+        if not isOn:
             # Something went wrong.
-            self.logger.log("Failed to turn on. Current status:\r\n")
-            self.loggerl.log(self.getStatus())
+            self.logger.log("Failed to turn on. Current status:\r\n",
+                            laser.ERROR)
+            self.logger.log('\r\n'.join(self.getStatus()), laser.ERROR)
             return False
         return True
 
 
     ## Turn the laser OFF.
-    @lockComms
+    @laser.invalidatesCache('isOn', 'power', 'status', 'fault')
+    @laser.lockComms
+    @laser.priority(laser.URGENT)
     def disable(self):
-        self.logger.log("Turning laser OFF at %s" % time.strftime('%Y-%m-%d %H:%M:%S'))
-        self.write('l0')
-        return self.readline()
+        self.logger.log("Turning laser OFF.")
+        return self.command('emission', 0)
 
 
-    ## Return True if the laser is currently able to produce light.
-    @lockComms
-    def getIsOn(self):
-        self.write('l?')
-        response = self.readline()
-        return response == '1'
+    ## Return the fault code; 0 means no fault.
+    @laser.cachedQuery('fault')
+    @laser.lockComms
+    def getFault(self):
+        return self.command('fault')
 
 
-    @lockComms
-    def getMaxPower_mW(self):
-        # 'gmlp?' gets the maximum laser power in mW.
-        self.write('gmlp?')
-        response = self.readline()
-        return float(response)
+    ## Return True if the laser is currently able to produce light.
+    @laser.cachedQuery('isOn')
+    @laser.lockComms
+    def getIsOn(self):
+        return self.command('isOn')
 
 
-    @lockComms
+    @laser.cachedQuery('power')
+    @laser.lockComms
     def getPower_mW(self):
-        if not self.getIsOn():
+        isOn, power = self.commandMany(['isOn', 'power'])
+        if not isOn:
             return 0
-        self.write('pa?')
-        return 1000 * float(self.readline())
+        return power
 
 
-    @lockComms
+    @laser.invalidatesCache('power', 'setPower', 'status')
+    @laser.lockComms
     def setPower_mW(self, mW):
-        mW = min(mW, self.getMaxPower_mW)
-        self.logger.log("Setting laser power to %.4fW at %s"  % (mW / 1000.0, time.strftime('%Y-%m-%d %H:%M:%S')))
-        return self.send("@cobasp %.4f" % (mW / 1000.0))
+        mW = min(mW, self.getMaxPower_mW())
+        self.logger.log("Setting laser power to %.4fW", laser.INFO,
+                        mW / 1000.0)
+        return self.command('setPower', mW)
+
+
+    @laser.lockComms
+    def readTelemetry(self):
+        power, isOn, fault, hours = self.commandMany(
+                ['power', 'isOn', 'fault', 'hours'])
+        return {'power_mW': power,
+                'isOn': isOn,
+                'fault': fault,
+                'hours': hours}
 
 
-    @lockComms
+    @laser.cachedQuery('setPower')
+    @laser.lockComms
     def getSetPower_mW(self):
-        self.write('p?')
-        return 1000 * float(self.readline())
+        return self.command('targetPower')
 
 
 if __name__ == "__main__":
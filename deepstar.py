@@ -15,177 +15,310 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import Pyro4
-import serial
 import socket
-import threading
 import time
-import functools
 import laser
+import protocol
+import re
+import transport
 
 CONFIG_NAME = 'deepstar'
 CLASS_NAME = 'DeepstarLaser'
 
-def flushBuffer(func):
-    """A decorator to flush the input buffer prior to issuing a command.
-
-    There have been problems with the DeepStar lasers returning junk characters
-    after the expected response, so it is advisable to flush the input buffer
-    prior to running a command and subsequent readline. It also locks the comms
-    channel so that a function must finish all its comms before another can run.
-    """
-    @functools.wraps(func)
-    def wrapper(self, *args, **kwargs):
-        with self.commsLock:
-            self.connection.flushInput()
-            return func(self, *args, **kwargs)
-
-    return wrapper
+# Power levels are 12-bit, as 3 hex digits.
+MAX_LEVEL = 0xFFF
+LEVEL = r'PP([0-9A-F]{3})'
+
+## The DeepStar protocol; see protocol.Command.
+PROTOCOL = {
+    # S0, S1 and S2 are the normal states; S2 means emission is on.
+    'state': protocol.Command('S?', r'S[0-9]'),
+    'on': protocol.Command('LON'),
+    'off': protocol.Command('LF'),
+    # Deepstar mode with internal voltage reference.
+    'mode': protocol.Command('L2'),
+    'internalPeakPower': protocol.Command('IPO'),
+    # Turn off internal digital and bias modulation.
+    'modulationOff': protocol.Command('MF'),
+    'level': protocol.Command('PP?', LEVEL, lambda r: int(r, 16)),
+    'setLevel': protocol.Command('PP%03X', LEVEL, lambda r: int(r, 16),
+                                 encode=lambda level: int(level * MAX_LEVEL)),
+    'status': protocol.Command('STAT%d'),
+    }
+
+## Expected response frames, by command name (see laser.COMMAND_NAME).
+# A response of known shape is complete as soon as it matches; any other
+# response is a line of printable characters ending in CR/LF, starting with
+# a capital or digit like all DeepStar responses.
+RESPONSE_FRAMES = protocol.frames(
+        PROTOCOL, lambda command: laser.COMMAND_NAME.match(command).group())
+LINE_FRAME = re.compile(r'([A-Z0-9][\x20-\x7e]*)\r?\n')
+# A line terminator left after a frame of known shape.
+TERMINATOR = re.compile(r'\r?\n?')
+# Most bytes read from the port at once.
+READ_SIZE = 64
+
+
+## Return (command padded to 16 bytes less CR/LF, bytes to send).
+# There's also a 7-byte mode but we never need to use it.
+def _frameCommand(command):
+    padded = command.ljust(14)
+    return padded, padded + '\r\n'
+
+ENCODER = protocol.Encoder(_frameCommand, PROTOCOL)
+
+## Response frames by the (padded) command string sent.
+_frames = {}
+
+
+## Return the response frame for a command sent, or None for a line.
+def frameFor(command):
+    try:
+        return _frames[command]
+    except KeyError:
+        match = laser.COMMAND_NAME.match(command)
+        frame = RESPONSE_FRAMES.get(match.group() if match else None)
+        if len(_frames) < ENCODER.maxSize:
+            _frames[command] = frame
+        return frame
 
 
 class DeepstarLaser(laser.Laser):
+    protocol = PROTOCOL
+
     def __init__(self, serialPort, baudRate, timeout):
-        super(DeepstarLaser, self).__init__()
+        super(DeepstarLaser, self).__init__(serialPort, baudRate, timeout)
         print "Connecting to laser on port",serialPort,"with rate",baudRate,"and timeout",timeout
-        self.connection = serial.Serial(port = serialPort,
-            baudrate = baudRate, timeout = timeout,
-            stopbits = serial.STOPBITS_ONE,
-            bytesize = serial.EIGHTBITS, parity = serial.PARITY_NONE)
+        self.connection = transport.openPort(serialPort, baudRate, timeout)
         # Start a logger.
         self.logger = laser.LaserLogger()
         self.logger.open('DeepStar_' + serialPort)
+        self._handshake()
+
+
+    ## Commands to run each time the port is opened.
+    def _handshake(self):
+        # Bytes read but not yet framed as a response.
+        self.rxBuffer = bytearray()
+        # Reused for each read from the port.
+        self.readBuffer = memoryview(bytearray(READ_SIZE))
         # If the laser is currently on, then we need to use 7-byte mode; otherwise we need to
         # use 16-byte mode.
-        self.write('S?')
-        response = self.readline()
-        self.logger.log("Current laser state: [%s]" % response)
-        self.commsLock = threading.RLock()
-        
+        self.logger.log("Current laser state: [%s]" %
+                        self.command('state'))
+        self.refreshConstants()
+        self.logger.log("Laser model: [%s]" % self.constants['model'])
+
 
     ## Simple passthrough.
     def read(self, numChars):
         return self.connection.read(numChars)
 
 
-    ## Simple passthrough.
+    ## Read the response to the oldest command awaiting one.
     def readline(self):
-        return self.connection.readline().strip()
-
-
-    ## Send a command.
+        self.applyDeadline()
+        command = self.pendingCommands[0][0] if self.pendingCommands else ''
+        response = self.readFrame(frameFor(command))
+        # Only a missing response counts as a timeout.
+        self.noteResponse('' if response is None else response + '\n')
+        return response or ''
+
+
+    ## Discard and count bytes received but not read, without waiting.
+    def discardInput(self):
+        waiting = self.connection.inWaiting()
+        if waiting:
+            self.rxBuffer += self.connection.read(waiting)
+        if self.rxBuffer:
+            junk = self.rxBuffer.strip('\r\n ')
+            if junk:
+                self.metrics.increment('discardedBytes', len(junk))
+            del self.rxBuffer[:]
+
+
+    ## Read up to size bytes onto rxBuffer through readBuffer, without
+    # waiting longer than the read timeout. Return the number read.
+    def readInto(self, size):
+        readinto = getattr(self.connection, 'readinto', None)
+        if readinto is None:
+            data = self.connection.read(size)
+            self.rxBuffer += data
+            return len(data)
+        view = self.readBuffer[:min(size, READ_SIZE)]
+        n = readinto(view) or 0
+        self.rxBuffer += view[:n]
+        return n
+
+
+    ## Return the first response matching frame (or a printable line if
+    # frame is None), or None if none arrives within the read timeout.
+    # Bytes before the response are junk: they are discarded and counted.
+    # A response of known shape is returned as soon as it is complete; if
+    # a whole line that does not match it arrives instead (e.g. the error
+    # response UK), the line is returned, for decode to reject.
+    def readFrame(self, frame=None):
+        timeout = self.connection.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            match = None if frame is None else frame.search(self.rxBuffer)
+            isLine = match is None
+            if isLine:
+                match = LINE_FRAME.search(self.rxBuffer)
+            if match:
+                if match.start():
+                    junk = self.rxBuffer[:match.start()].strip('\r\n ')
+                    if junk:
+                        self.metrics.increment('discardedBytes', len(junk))
+                end = match.end()
+                if not isLine:
+                    end = TERMINATOR.match(self.rxBuffer, end).end()
+                response = str(match.group(1 if isLine else 0))
+                del self.rxBuffer[:end]
+                return response.strip()
+            if deadline is not None:
+                # Each read may block for the port's timeout, so limit it to
+                # the time left.
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if remaining < self.connection.timeout:
+                    self.connection.timeout = remaining
+            if not self.readInto(max(self.connection.inWaiting(), 1)):
+                break
+        # Timed out: what we have cannot be framed, so discard it.
+        self.discardInput()
+        return None
+
+
+    ## Send a command, padded out to 16 bytes; see _frameCommand.
     def write(self, command):
-        # We'll need to pad the command out to 16 bytes. There's also a 7-byte mode but
-        # we never need to use it.
-        commandLength = 16
-        # CR/LF count towards the byte limit, hence the -2.
-        command = command + (' ' * (commandLength - 2 - len(command)))
-        response = self.connection.write(command + '\r\n')
+        command, data = ENCODER.encode(command)
+        if not self.pendingCommands:
+            # Nothing is awaited, so anything unread is junk, but responses
+            # owed to earlier transactions may still be on their way.
+            self.discardStaleResponses(lambda: self.readFrame() is not None)
+            self.discardInput()
+        response = self.connection.write(data)
+        self.noteWrite(command)
         return response
 
 
     ## Get the status of the laser, by sending the
     # STAT0, STAT1, STAT2, and STAT3 commands.
-    @flushBuffer
+    @laser.cachedQuery('status')
+    @laser.lockComms
     def getStatus(self):
-        result = []
-        for i in xrange(4):
-            self.write('STAT%d' % i)
-            result.append(self.readline())
-        return result
+        return self.commandMany([('status', i) for i in xrange(4)])
 
 
     ## Turn the laser ON. Return True if we succeeded, False otherwise.
-    @flushBuffer
+    @laser.invalidatesCache('isOn', 'power', 'status', 'fault')
+    @laser.lockComms
     def enable(self):
         self.logger.log("Turning laser ON.")
-        self.write('LON')
-        response = self.readline()
-        #Turn on deepstar mode with internal voltage ref
-        self.logger.log("Enable response: [%s]" % response)
-        self.write('L2')
-        response = self.readline()
-        self.logger.log("L2 response: [%s]" % response)
-        #Enable internal peak power
-        self.write('IPO')
-        response = self.readline()
-        self.logger.log("Enable-internal peak power response: [%s]" % response)
-        #Set MF turns off internal digital and bias modulation
-        self.write('MF')
-        response = self.readline()
-        self.logger.log("MF response [%s]" % response)
-
-        if not self.getIsOn():
+        # Switch emission on, set up the mode and check the resulting state.
+        responses = self.commandMany(['on', 'mode', 'internalPeakPower',
+                                      'modulationOff', 'state'])
+        self.logger.log("Enable response: [%s]" % responses[0])
+        self.logger.log("L2 response: [%s]" % responses[1])
+        self.logger.log("Enable-internal peak power response: [%s]" % responses[2])
+        self.logger.log("MF response [%s]" % responses[3])
+
+        if responses[4] != 'S2':
             # Something went wrong.
-            self.write('S?')
-            response = self.readline()
-            self.logger.log("Failed to turn on. Current status: %s" % response)
+            self.logger.log("Failed to turn on. Current status: %s" % responses[4],
+                            laser.ERROR)
             return False
         return True
 
 
     ## Turn the laser OFF.
-    @flushBuffer
+    @laser.invalidatesCache('isOn', 'power', 'status', 'fault')
+    @laser.lockComms
+    @laser.priority(laser.URGENT)
     def disable(self):
         self.logger.log("Turning laser OFF.")
-        self.write('LF')
-        return self.readline()
+        return self.command('off')
 
 
-    @flushBuffer
+    @laser.lockComms
     def isAlive(self):
-        self.write('S?')
-        response = self.readline()
-        return response.startswith('S')
+        try:
+            self.command('state')
+        except protocol.ProtocolError:
+            return False
+        return True
 
 
     ## Return True if the laser is currently able to produce light. We assume this is equivalent
     # to the laser being in S2 mode.
-    @flushBuffer
+    @laser.cachedQuery('isOn')
+    @laser.lockComms
     def getIsOn(self):
-        self.write('S?')
-        response = self.readline()
-        self.logger.log("Are we on? [%s]" % response)
+        response = self.command('state')
+        self.logger.log("Are we on? [%s]", laser.DEBUG, response)
         return response == 'S2'
 
 
-    @flushBuffer
+    ## Return True if the laser is in an abnormal state.
+    # There is no fault query; S0, S1 and S2 are the normal states.
+    @laser.cachedQuery('fault')
+    @laser.lockComms
+    def getFault(self):
+        try:
+            return self.command('state') not in ('S0', 'S1', 'S2')
+        except protocol.ProtocolError:
+            return True
+
+
+    @laser.invalidatesCache('power', 'status')
+    @laser.lockComms
     def setPower(self, level):
         if (level > 1.0) :
             return
-        self.logger.log("level=%d" % level)
-        power=int (level*0xFFF)
-        self.logger.log("power=%d" % power)
-        strPower = "PP%03X" % power
-        self.logger.log("power level=%s" %strPower)
-        self.write(strPower)
-        response = self.readline()
-        self.logger.log("Power response [%s]" % response)
+        self.logger.log("level=%f", laser.DEBUG, level)
+        response = self.command('setLevel', level)
+        self.logger.log("Power response [%03X]", laser.DEBUG, response)
         return response
 
 
-    @flushBuffer
-    def getMaxPower_mW(self):
+    @laser.lockComms
+    def _readConstants(self):
         # Max power in mW is third token of STAT0.
-        self.write('STAT0')
-        response = self.readline()
-        return int(response.split()[2])
+        response = self.command('status', 0)
+        return {'model': response,
+                'maxPower_mW': int(response.split()[2])}
 
 
-    @flushBuffer
+    @laser.lockComms
     def getPower(self):
         if not self.getIsOn():
             # Laser is not on.
             return 0
-        self.write('PP?')
-        response = self.readline()
-        return int('0x' + response.strip('PP'), 16)
+        return self.command('level')
+
+
+    @laser.lockComms
+    def readTelemetry(self):
+        state, level = self.commandMany(['state', 'level'])
+        isOn = state == 'S2'
+        return {'power_mW': self.getMaxPower_mW() * float(level) / MAX_LEVEL,
+                'isOn': isOn,
+                'fault': int(state not in ('S0', 'S1', 'S2')),
+                'hours': float('nan')}
 
 
+    @laser.cachedQuery('power')
+    @laser.lockComms
     def getPower_mW(self):
         maxPower = self.getMaxPower_mW()
         power = self.getPower()
-        return maxPower * float(power) / float(0xFFF)
+        return maxPower * float(power) / MAX_LEVEL
 
 
+    @laser.invalidatesCache('power', 'status')
+    @laser.lockComms
     def setPower_mW(self, mW):
         maxPower = self.getMaxPower_mW()
         level = float(mW) / maxPower
@@ -0,0 +1,72 @@
+"""A registry of Laser drivers for the laser server.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## Drivers are named as in the supported option of the server config, and a
+# laser section uses the driver whose name its own name starts with, e.g.
+# section deepstar488 uses driver deepstar. DRIVERS maps each name to the
+# module implementing it, whose CLASS_NAME names the Laser class. A driver
+# module is only imported when a section needs it; a name not in DRIVERS is
+# taken to be a module of the same name, so new drivers need no registering.
+import threading
+import time
+
+DRIVERS = {'cobolt': 'cobolt',
+           'deepstar': 'deepstar'}
+
+# Imported driver modules, by name, and how long each import took in s.
+_modules = {}
+_loadTimes = {}
+_lock = threading.Lock()
+
+
+## Register module (a module name) as the driver called name.
+def register(name, module):
+    DRIVERS[name] = module
+
+
+## Return the name of the driver for a section, from those in names, or None.
+# Where several names match, the longest wins.
+def driverFor(section, names):
+    matches = [name for name in names if name and section.startswith(name)]
+    if not matches:
+        return None
+    return max(matches, key=len)
+
+
+## Import and return the module for the driver called name.
+def load(name):
+    with _lock:
+        if name not in _modules:
+            t0 = time.time()
+            module = DRIVERS.get(name, name)
+            try:
+                _modules[name] = __import__(module)
+            except ImportError as e:
+                raise Exception("Could not load module %s: %s." % (module, e))
+            _loadTimes[name] = time.time() - t0
+        return _modules[name]
+
+
+## Return the Laser class for the driver called name.
+def getClass(name):
+    module = load(name)
+    return getattr(module, module.CLASS_NAME)
+
+
+## Return the time taken to import each driver loaded so far, in s.
+def getLoadTimes():
+    return dict(_loadTimes)
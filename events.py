@@ -0,0 +1,102 @@
+"""State-change events for Laser classes.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## An EventHub delivers events to subscribed callbacks and keeps a short
+# history that clients can read as a stream. A callback may be a Pyro proxy
+# for an object with an onLaserEvent(event) method, or any callable.
+# Each event is a dict with keys 'id', 'time', 'type' and 'value'.
+import collections
+import Pyro4
+import threading
+import time
+import Queue
+
+# Event types.
+EMISSION = 'emission'
+FAULT = 'fault'
+COMMS_LOST = 'commsLost'
+COMMS_RESTORED = 'commsRestored'
+
+# Drop a subscriber after this many failed deliveries in a row.
+MAX_FAILURES = 3
+
+
+class EventHub(object):
+    def __init__(self, history=1000):
+        self.history = collections.deque(maxlen=history)
+        self.nextId = 1
+        self.condition = threading.Condition()
+        # Map subscriber to its consecutive delivery failures.
+        self.subscribers = {}
+        self.queue = Queue.Queue()
+        self.dispatcher = threading.Thread(target=self._dispatch,
+                                           name='events')
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+
+    ## Record an event and queue it for delivery to subscribers.
+    def publish(self, type, value):
+        with self.condition:
+            event = {'id': self.nextId, 'time': time.time(),
+                     'type': type, 'value': value}
+            self.nextId += 1
+            self.history.append(event)
+            self.condition.notify_all()
+        self.queue.put(event)
+        return event
+
+
+    def subscribe(self, callback):
+        self.subscribers[callback] = 0
+
+
+    def unsubscribe(self, callback):
+        self.subscribers.pop(callback, None)
+
+
+    ## Return events with id > sinceId, waiting up to timeout s for one.
+    def getEvents(self, sinceId=0, timeout=0):
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                events = [e for e in self.history if e['id'] > sinceId]
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                self.condition.wait(remaining)
+
+
+    def _dispatch(self):
+        while True:
+            event = self.queue.get()
+            for callback in self.subscribers.keys():
+                try:
+                    if (isinstance(callback, Pyro4.Proxy)
+                            or hasattr(callback, 'onLaserEvent')):
+                        callback.onLaserEvent(event)
+                    else:
+                        callback(event)
+                except Exception:
+                    failures = self.subscribers.get(callback, 0) + 1
+                    if failures >= MAX_FAILURES:
+                        self.unsubscribe(callback)
+                    elif callback in self.subscribers:
+                        self.subscribers[callback] = failures
+                else:
+                    if callback in self.subscribers:
+                        self.subscribers[callback] = 0
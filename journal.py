@@ -0,0 +1,175 @@
+"""Journals of the raw bytes exchanged with a laser.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## A Journal records each write to and read from a port as a record of
+# HEADER (time, kind, method id, length) followed by the bytes. The method
+# is the Laser method that made the transfer; each method name is written
+# once, in a NAME record that gives its id. read() yields the records back
+# as (time, kind, method, data), and replay.py feeds them to a simulator.
+# Like the log files, a journal is rotated when it exceeds maxBytes, keeping
+# backupCount old files as name.jnl.1, name.jnl.2, ...; each file starts its
+# own NAME records, so it can be read on its own.
+import os
+import struct
+import threading
+import time
+
+HEADER = struct.Struct('<dBHH')
+# Record kinds.
+TX = 1
+RX = 2
+NAME = 3
+# Flush the file at most this often, in s.
+FLUSH_INTERVAL = 1.
+# Default size at which to rotate, and number of old files to keep.
+MAX_BYTES = 50 * 2**20
+BACKUP_COUNT = 2
+
+
+## Return the default journal file for a name, next to the log files.
+def defaultFilename(name):
+    path = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(path, '%s.jnl' % name)
+
+
+## Records transfers on one or more ports to a file.
+class Journal(object):
+    def __init__(self, filename, getMethod=None, maxBytes=MAX_BYTES,
+                 backupCount=BACKUP_COUNT):
+        self.filename = filename
+        # getMethod() returns the name of the method making a transfer.
+        self.getMethod = getMethod or (lambda: None)
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.lock = threading.Lock()
+        self._openFile()
+        self.lastFlush = time.time()
+
+
+    def _openFile(self):
+        self.fh = open(self.filename, 'ab', 2**16)
+        # Map method names to ids, as written to this file.
+        self.methods = {}
+
+
+    def _rotate(self):
+        self.fh.close()
+        for i in xrange(self.backupCount, 0, -1):
+            old = self.filename if i == 1 else '%s.%d' % (self.filename, i - 1)
+            new = '%s.%d' % (self.filename, i)
+            if os.path.exists(old):
+                if os.path.exists(new):
+                    os.remove(new)
+                os.rename(old, new)
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self._openFile()
+
+
+    ## Record data sent (kind TX) or received (kind RX).
+    def record(self, kind, data):
+        if not data:
+            return
+        now = time.time()
+        method = self.getMethod() or ''
+        with self.lock:
+            if self.fh is None:
+                return
+            if self.maxBytes and self.fh.tell() >= self.maxBytes:
+                self._rotate()
+            methodId = self.methods.get(method)
+            if methodId is None:
+                methodId = self.methods[method] = len(self.methods)
+                self.fh.write(HEADER.pack(now, NAME, methodId, len(method)))
+                self.fh.write(method)
+            self.fh.write(HEADER.pack(now, kind, methodId, len(data)))
+            self.fh.write(data)
+            if now - self.lastFlush > FLUSH_INTERVAL:
+                self.fh.flush()
+                self.lastFlush = now
+
+
+    ## Return port wrapped so that its transfers are recorded.
+    def wrap(self, port):
+        return JournalledPort(port, self)
+
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+
+## A port that records its transfers in a Journal. Other attributes are
+# those of the wrapped port.
+class JournalledPort(object):
+    def __init__(self, port, journal):
+        self.__dict__['port'] = port
+        self.__dict__['journal'] = journal
+
+
+    def write(self, data):
+        self.journal.record(TX, data)
+        return self.port.write(data)
+
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self.journal.record(RX, data)
+        return data
+
+
+    def readinto(self, buffer):
+        n = self.port.readinto(buffer)
+        if n:
+            self.journal.record(RX, memoryview(buffer)[:n].tobytes())
+        return n
+
+
+    def readline(self, *args):
+        data = self.port.readline(*args)
+        self.journal.record(RX, data)
+        return data
+
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+
+    # Set attributes such as timeout on the wrapped port.
+    def __setattr__(self, name, value):
+        setattr(self.port, name, value)
+
+
+## Yield the records in a journal file as (time, kind, method, data).
+def read(filename):
+    methods = {}
+    with open(filename, 'rb') as fh:
+        while True:
+            header = fh.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            t, kind, methodId, length = HEADER.unpack(header)
+            data = fh.read(length)
+            if len(data) < length:
+                # Cut short, e.g. by a crash.
+                return
+            if kind == NAME:
+                methods[methodId] = data
+            else:
+                yield t, kind, methods.get(methodId, ''), data
@@ -18,12 +18,28 @@ limitations under the License.
 ## This module defines the interface for a laser that can be controlled
 # by cockpit.devices.laserpower.
 import abc
+import contextlib
+import events
+import functools
+import collections
+import heapq
+import itertools
+import journal
+import metrics
 import os
 import Pyro4
+import Queue
+import re
+import sequencer
+import stabiliser
 import serial
 import socket
+import sys
+import telemetry
+import thread
 import threading
 import time
+import transport
 
 # The name of the config section for this device
 CONFIG_NAME = 'dummyLaser'
@@ -32,46 +48,1177 @@ CLASS_NAME = 'Laser'
 
 
 def _storeSetPoint(func):
-    def _wrappedSetPower(self, mW):
+    def _wrappedSetPower(self, mW, **kwargs):
         self.powerSetPoint_mW = mW
         # self seems to be passed implicitly due to binding.
-        func(mW)
+        return func(mW, **kwargs)
     return _wrappedSetPower
 
 
+def _fromSnapshot(key):
+    """Return a decorator that serves a getter from the status snapshot.
+
+    While the poller is serving getters and the snapshot is fresh, the wrapped getter
+    returns the snapshot value without touching the port; otherwise it falls
+    through to the device. A snapshot taken before the last command that
+    changes the device's state is not fresh, and calls made within a comms
+    transaction always go to the device.
+    """
+    def decorator(func):
+        def _wrappedGetter(self, *args, **kwargs):
+            snapshot = self.snapshot
+            if (self.serveSnapshot and key in snapshot and not args
+                    and set(kwargs) <= set(['timeout'])
+                    and snapshot['generation'] == self.snapshotGeneration
+                    and time.time() - snapshot['time'] < 3 * self.pollInterval
+                    and not self.commsLock.isOwned()):
+                return snapshot[key]
+            return func(*args, **kwargs)
+        return _wrappedGetter
+    return decorator
+
+
+## Notifies conditions at given times, from one thread. In Python 2 a wait
+# with a timeout polls, sleeping up to 50 ms between checks, so a waiter can
+# miss a notify by that long; instead, waiters wait without a timeout and
+# have the Waker notify them when their deadline passes (see waitFor).
+class Waker(object):
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        # Heap of [time, sequence, condition].
+        self.heap = []
+        self.sequence = itertools.count()
+        self.thread = None
+
+    ## Notify condition at time when; return an entry for cancel.
+    def add(self, when, condition):
+        entry = [when, next(self.sequence), condition]
+        with self.condition:
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='waker')
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.heap[0] is entry:
+                self.condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self.condition:
+            try:
+                self.heap.remove(entry)
+            except ValueError:
+                # Already notified.
+                return
+            heapq.heapify(self.heap)
+
+    def _run(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                remaining = self.heap[0][0] - time.time()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                condition = heapq.heappop(self.heap)[2]
+                # Waiters hold their condition when they add an entry, so
+                # take it without holding ours.
+                self.condition.release()
+                try:
+                    with condition:
+                        condition.notify_all()
+                finally:
+                    self.condition.acquire()
+
+_waker = Waker()
+
+
+## Wait on condition, which the caller holds, until predicate() is true or
+# deadline (from time.time(), or None for no limit) passes. Return the last
+# value of predicate().
+def waitFor(condition, predicate, deadline=None):
+    if deadline is None:
+        while not predicate():
+            condition.wait()
+        return True
+    entry = _waker.add(deadline, condition)
+    try:
+        while not predicate():
+            if time.time() >= deadline:
+                return False
+            condition.wait()
+        return True
+    finally:
+        _waker.cancel(entry)
+
+
+## A cache of query responses, with coalescing of concurrent queries.
+# Only queries whose name has an entry in ttl are cached: their results are
+# reused for ttl seconds, and a query made while an identical one is in
+# flight waits for and shares its result. Invalidation bumps a generation
+# count, so a query in flight across a write does not refill the cache.
+class ResponseCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Notified when an in-flight query finishes.
+        self.finished = threading.Condition(self.lock)
+        # Map query name to time-to-live in s; 0 coalesces without caching.
+        self.ttl = {}
+        # Map (name, args) to (time, value).
+        self.entries = {}
+        # Map (name, args) to an in-flight query, as [done, value, error].
+        self.inflight = {}
+        # Map name to generation count.
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    ## Return the result of fetch() for key, cached or shared if possible.
+    # A query waiting for one in flight raises CommsTimeout after timeout s,
+    # if timeout is not None.
+    def get(self, key, fetch, timeout=None):
+        name = key[0]
+        ttl = self.ttl.get(name)
+        if ttl is None:
+            return fetch()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] < ttl:
+                self.hits += 1
+                return entry[1]
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = [False, None, None]
+                generation = self.generations.get(name, 0)
+                self.misses += 1
+            else:
+                self.coalesced += 1
+                deadline = None if timeout is None else time.time() + timeout
+                if not waitFor(self.finished, lambda: call[0], deadline):
+                    raise CommsTimeout('Timed out after %g s waiting for a '
+                                       'shared query.' % timeout)
+        if not leader:
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = fetch()
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+                if (call[2] is None and ttl
+                        and self.generations.get(name, 0) == generation):
+                    self.entries[key] = (time.time(), call[1])
+                call[0] = True
+                self.finished.notify_all()
+        return call[1]
+
+    ## Drop cached results for the named queries, or all if none are named.
+    def invalidate(self, *names):
+        with self.lock:
+            for key in self.entries.keys():
+                if not names or key[0] in names:
+                    del self.entries[key]
+            for name in names or self.ttl.keys():
+                self.generations[name] = self.generations.get(name, 0) + 1
+
+    def getStats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'coalesced': self.coalesced, 'ttl': dict(self.ttl)}
+
+
+## Decorator for an idempotent query, served through the response cache
+# under name. A timeout keyword argument is passed on but not part of the
+# cache key; it also limits the wait for a shared query. Apply it above the
+# driver's comms decorator, so that a cache hit does not wait for the comms
+# lock.
+def cachedQuery(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.commsLock.isOwned():
+                # Called within another comms call: waiting on a query that
+                # is itself waiting for our lock would deadlock.
+                return func(self, *args, **kwargs)
+            timeout = kwargs.get('timeout')
+            if timeout is None:
+                timeout = self.defaultTimeout
+            return self.responseCache.get(
+                    (name, args), lambda: func(self, *args, **kwargs),
+                    timeout)
+        return wrapper
+    return decorator
+
+
+## Decorator for a command that changes the results of the named queries
+# (all queries if none are named): invalidates them, and the status
+# snapshot, before and after.
+def invalidatesCache(*names):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            self.responseCache.invalidate(*names)
+            self.invalidateSnapshot()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.responseCache.invalidate(*names)
+                self.invalidateSnapshot()
+        return wrapper
+    return decorator
+
+
+## Raised by comms calls while a device is degraded and being reconnected.
+class LaserUnavailable(Exception):
+    pass
+
+
+## Raised when a comms call cannot complete within its timeout.
+class CommsTimeout(Exception):
+    pass
+
+
+# Command priorities for CommandScheduler; lower runs first.
+URGENT = 0
+NORMAL = 10
+BACKGROUND = 20
+
+
+## Decorator to set the comms priority of a method, e.g. for emission off.
+# Apply it beneath the driver's comms decorator.
+def priority(level):
+    def decorator(func):
+        func.commsPriority = level
+        return func
+    return decorator
+
+
+## Decorator to run a method as one comms transaction (see Laser.comms), so
+# that it finishes all its comms before another method can start. The
+# wrapped method takes an optional timeout keyword argument, in seconds.
+def lockComms(func):
+    priority = getattr(func, 'commsPriority', NORMAL)
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.comms(kwargs.pop('timeout', None), priority, func.__name__):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+## A re-entrant comms lock that grants waiting commands by priority, then in
+# order of arrival. The holder can call yieldToUrgent between transactions
+# to let a more urgent command run part-way through a multi-step sequence.
+class CommandScheduler(object):
+    def __init__(self, metrics=None):
+        # A metrics.Metrics for lock wait and hold time histograms.
+        self.metrics = metrics
+        self.condition = threading.Condition(threading.Lock())
+        self.owner = None
+        self.count = 0
+        self.ownerPriority = None
+        self.acquiredAt = None
+        # Heap of waiters as (priority, sequence, thread id).
+        self.waiters = []
+        self.sequence = 0
+        # Metrics.
+        self.maxDepth = 0
+        self.preemptions = 0
+        self.timeouts = 0
+        self.waitStats = {}
+        self.holdStats = [0, 0., 0.]
+
+    ## Return True if the calling thread holds the lock.
+    def isOwned(self):
+        return self.owner == thread.get_ident()
+
+    ## Acquire the lock, waiting at most timeout s if timeout is not None.
+    # Return True if the lock was acquired.
+    def acquire(self, blocking=True, timeout=None, priority=NORMAL,
+                _sequence=None):
+        me = thread.get_ident()
+        with self.condition:
+            if self.owner == me:
+                self.count += 1
+                return True
+            if self.owner is None and not self.waiters:
+                self._take(me, priority, 0)
+                return True
+            if not blocking:
+                return False
+            t0 = time.time()
+            if _sequence is None:
+                self.sequence += 1
+                _sequence = self.sequence
+            entry = (priority, _sequence, me)
+            heapq.heappush(self.waiters, entry)
+            self.maxDepth = max(self.maxDepth, len(self.waiters))
+            if not waitFor(self.condition,
+                           lambda: (self.owner is None
+                                    and self.waiters[0] == entry),
+                           None if timeout is None else t0 + timeout):
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.timeouts += 1
+                # Another waiter may now be at the head.
+                self.condition.notify_all()
+                return False
+            heapq.heappop(self.waiters)
+            self._take(me, priority, time.time() - t0)
+            return True
+
+    def _take(self, me, priority, waited):
+        self.owner = me
+        self.count = 1
+        self.ownerPriority = priority
+        self.acquiredAt = time.time()
+        stats = self.waitStats.setdefault(priority, [0, 0., 0.])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        if self.metrics:
+            self.metrics.observe('lock.wait', waited)
+
+    def _releaseAll(self):
+        held = time.time() - self.acquiredAt
+        self.holdStats[0] += 1
+        self.holdStats[1] += held
+        self.holdStats[2] = max(self.holdStats[2], held)
+        if self.metrics:
+            self.metrics.observe('lock.hold', held)
+        self.owner = None
+        self.count = 0
+        self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            if self.owner != thread.get_ident():
+                raise RuntimeError('Cannot release an un-acquired lock.')
+            self.count -= 1
+            if not self.count:
+                self._releaseAll()
+
+    ## If a more urgent command is waiting, let it run, then take the lock
+    # back ahead of other commands of our own priority. Return True if we
+    # yielded.
+    def yieldToUrgent(self):
+        with self.condition:
+            if (self.owner != thread.get_ident() or not self.waiters
+                    or self.waiters[0][0] >= self.ownerPriority):
+                return False
+            count, priority = self.count, self.ownerPriority
+            self.preemptions += 1
+            self._releaseAll()
+        self.acquire(priority=priority, _sequence=0)
+        self.count = count
+        return True
+
+    ## Return queue depth, wait- and hold-time metrics.
+    # Times are (count, total s, max s); waits are keyed by priority.
+    def getStats(self):
+        with self.condition:
+            return {'depth': len(self.waiters),
+                    'maxDepth': self.maxDepth,
+                    'preemptions': self.preemptions,
+                    'timeouts': self.timeouts,
+                    'wait': dict((p, tuple(v))
+                                 for p, v in self.waitStats.iteritems()),
+                    'hold': tuple(self.holdStats)}
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# The name part of a command, used to label command timers.
+COMMAND_NAME = re.compile(r'[@A-Za-z?]+')
+# Metric names by command string, and by method name, so that the hot path
+# does not build them on every call. Commands with arguments are only added
+# while the table is small.
+_commandMetrics = {}
+_methodMetrics = {}
+MAX_COMMAND_METRICS = 1024
+
+
+## Return the metric name for a method, e.g. 'method.getStatus'.
+def _methodMetric(name):
+    metric = _methodMetrics.get(name)
+    if metric is None:
+        metric = _methodMetrics[name] = 'method.' + name
+    return metric
+
+
+## Return the metric name for a command, e.g. 'command.PP' for 'PP7FF'.
+def commandMetric(command):
+    metric = _commandMetrics.get(command)
+    if metric is None:
+        match = COMMAND_NAME.match(command)
+        metric = 'command.' + (match.group() if match else command)
+        if len(_commandMetrics) < MAX_COMMAND_METRICS:
+            _commandMetrics[command] = metric
+    return metric
+
+
+# Exceptions that indicate a problem with the comms channel.
+COMMS_ERRORS = (serial.SerialException, IOError, OSError)
+
+
+# Log levels for LaserLogger.
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+
+# Most time LaserLogger.close waits for queued messages to be written, in s.
+CLOSE_TIMEOUT = 5.
+
+
 ## A logger for laser objects.
+# Messages are queued by log() and written by a background thread, so that
+# logging never adds disk latency to the caller. The writer takes whatever
+# is queued, writes it and flushes once per batch. The file is appended to,
+# and rotated when it exceeds maxBytes or is older than maxAge seconds;
+# backupCount old files are kept as name.txt.1, name.txt.2, ...
 class LaserLogger(object):
-    def __init__(self):
+    def __init__(self, level=INFO, maxBytes=10 * 2**20, maxAge=None,
+                 backupCount=5, maxQueue=10000):
         self.fh = None
+        self.path = None
+        self.level = level
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.backupCount = backupCount
+        self.openedAt = None
+        self.queue = Queue.Queue(maxQueue)
+        self.writer = None
+        # Messages dropped because the queue was full.
+        self.dropped = 0
 
-    def log(self, message):
-        if self.fh:
-            self.fh.write(time.strftime('%Y-%m-%d %H:%M:%S:  '))
-            self.fh.write(message + '\n')
-            self.fh.flush()
+    ## Queue message for writing. If args are given, the message is
+    # formatted with them by the writer, off the caller's thread.
+    def log(self, message, level=INFO, *args):
+        if self.writer is None or level < self.level:
+            return
+        try:
+            self.queue.put_nowait((time.time(), message, args))
+        except Queue.Full:
+            self.dropped += 1
 
     def open(self, filename):
         path = os.path.dirname(os.path.abspath(__file__))
-        self.fh = open(os.path.join(path, str(filename) + '.txt'), 'w')
+        # Port names may be URLs, e.g. sim://deepstar.
+        filename = re.sub(r'[^\w.-]+', '_', str(filename))
+        self.path = os.path.join(path, filename + '.txt')
+        self._openFile()
+        self.writer = threading.Thread(target=self._writeLoop,
+                                       name='logger-' + filename)
+        self.writer.daemon = True
+        self.writer.start()
 
     def close(self):
+        if self.writer is None:
+            return
+        if self.writer.is_alive():
+            # A None entry tells the writer to finish.
+            try:
+                self.queue.put((None, None, None), timeout=CLOSE_TIMEOUT)
+            except Queue.Full:
+                pass
+            self.writer.join(CLOSE_TIMEOUT)
+        self.writer = None
         self.fh.close()
         self.fh = None
 
+    def _openFile(self):
+        self.fh = open(self.path, 'a')
+        self.openedAt = time.time()
+
+    def _shouldRotate(self):
+        if self.maxBytes and self.fh.tell() >= self.maxBytes:
+            return True
+        if self.maxAge and time.time() - self.openedAt >= self.maxAge:
+            return True
+        return False
+
+    def _rotate(self):
+        self.fh.close()
+        for i in xrange(self.backupCount - 1, 0, -1):
+            old = '%s.%d' % (self.path, i)
+            if os.path.exists(old):
+                new = '%s.%d' % (self.path, i + 1)
+                if os.path.exists(new):
+                    os.remove(new)
+                os.rename(old, new)
+        if self.backupCount:
+            new = self.path + '.1'
+            if os.path.exists(new):
+                os.remove(new)
+            os.rename(self.path, new)
+        else:
+            os.remove(self.path)
+        self._openFile()
+
+    def _writeLoop(self):
+        running = True
+        # The timestamp changes once a second, so format it once a second.
+        second = None
+        stamp = None
+        while running:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            # Errors are reported rather than raised, so that the writer
+            # keeps going.
+            try:
+                for t, message, args in batch:
+                    if t is None:
+                        running = False
+                        continue
+                    if int(t) != second:
+                        second = int(t)
+                        stamp = time.strftime('%Y-%m-%d %H:%M:%S:  ',
+                                              time.localtime(t))
+                    if args:
+                        try:
+                            message = message % args
+                        except Exception as e:
+                            message = ('Could not format log message %r with '
+                                       '%r: %s' % (message, args, e))
+                    self.fh.write(stamp)
+                    self.fh.write(message + '\n')
+                if self.dropped:
+                    self.fh.write('%d log messages dropped.\n' % self.dropped)
+                    self.dropped = 0
+                self.fh.flush()
+            except Exception as e:
+                print >> sys.stderr, "Could not write to %s: %s" % (self.path, e)
+            try:
+                if self._shouldRotate():
+                    self._rotate()
+            except Exception as e:
+                # E.g. another program has the file open on Windows; carry
+                # on with the current file.
+                print >> sys.stderr, "Could not rotate %s: %s" % (self.path, e)
+                if self.fh.closed:
+                    self._openFile()
+
 
 ## This is a prototype for a class to be used with laser_server.
 class Laser(object):
     __metaclass__ = abc.ABCMeta
 
+    ## Poll interval used to watch for events if the poller is not running.
+    eventPollInterval = 0.5
+    ## Mark the device degraded after this many comms failures in a row.
+    maxCommsFailures = 3
+    ## Seconds between attempts to reopen the port of a degraded device.
+    reconnectInterval = 2.
+
+    ## True if the device accepts further commands before it has replied to
+    # the previous one, and replies in order. Off by default: a section sets
+    # it with the pipeline option once this has been checked on the device.
+    canPipeline = False
+    # The device's protocol, as a table of protocol.Command by name.
+    protocol = {}
+
     @abc.abstractmethod
     def __init__(self, *args):
         ## Should connect to the physical device here and set self.connection
         # to a type with read, readline and write methods (e.g. serial.Serial).
+        # args are the (port, baudRate, timeout) for transport.openPort, kept
+        # so that the port can be reopened.
         self.connection = None
+        self.portArgs = args
+        # Timers and counters for the hot paths; see getMetrics.
+        self.metrics = metrics.Metrics()
+        # Commands written and awaiting a response, as (command, time).
+        self.pendingCommands = collections.deque()
+        # Responses still owed to transactions that were cut short (e.g. by
+        # a deadline); see discardStaleResponses.
+        self.staleResponses = 0
+        self.commsLock = CommandScheduler(self.metrics)
+        # The configured serial read timeout, and the deadline (from
+        # time.time()) of the comms transaction in progress, if any.
+        self.readTimeout = args[2] if len(args) > 2 else None
+        self.deadline = None
+        # Timeout for comms calls that do not specify one; None waits forever.
+        self.defaultTimeout = None
+        # Supervision: consecutive comms failures, and the thread that
+        # reopens the port while the device is degraded.
+        self.commsFailures = 0
+        self.commsDepth = 0
+        # The method making the current outermost comms transaction.
+        self.commsMethod = None
+        # Records raw transfers while started; see startJournal.
+        self.journal = None
+        self.degraded = False
+        self.reconnectThread = None
+        self.reconnectStop = threading.Event()
         self.powerSetPoint_mW = None
+        # Caches idempotent query responses; off until setCacheTTL is called.
+        self.responseCache = ResponseCache()
+        # Device facts that do not change while connected (max power,
+        # serial number, model ...), filled by refreshConstants.
+        self.constants = {}
+        # The stabiliser reads the device and corrects the power without
+        # going through the set point or the snapshot.
+        self.stabiliser = stabiliser.Stabiliser(
+                self.getPower_mW, lambda: self.powerSetPoint_mW,
+                self.setPower_mW, self.getMaxPower_mW)
         # Wrap derived-classes setPower_mW to store power set point.
         # The __get__(self, Laser) binds the wrapped function to an instance.
         self.setPower_mW = _storeSetPoint(self.setPower_mW).__get__(self, Laser)
+        # The status poller refreshes self.snapshot from these getters. The
+        # snapshot is replaced, never mutated, so readers need no lock.
+        self.snapshot = {}
+        # Commands that change the device's state move the generation on;
+        # getters only use a snapshot polled in the current generation.
+        self.snapshotGenerations = itertools.count()
+        self.snapshotGeneration = next(self.snapshotGenerations)
+        self.pollInterval = None
+        # Whether getters are served from the snapshot (see startPoller).
+        self.serveSnapshot = False
+        self.pollerThread = None
+        self.pollerStop = threading.Event()
+        self.snapshotSources = {'isOn': self.getIsOn,
+                                'power_mW': self.getPower_mW,
+                                'status': self.getStatus,
+                                'fault': self.getFault}
+        for key, getter in self.snapshotSources.iteritems():
+            wrapped = _fromSnapshot(key)(getter).__get__(self, Laser)
+            setattr(self, getter.__name__, wrapped)
+        # Runs power sequences on a thread of its own.
+        self.sequencer = sequencer.Sequencer(self.setPower_mW)
+        # Records telemetry while started.
+        self.telemetry = None
+        # State changes seen by the poller are published here.
+        self.events = events.EventHub()
+
+
+    ## Commands to run each time the port is opened. Derived classes that
+    # need more setup should extend this.
+    def _handshake(self):
+        self.refreshConstants()
+
+
+    ## Wrap a comms transaction: take the comms lock, fail fast while the
+    # device is degraded, and count comms errors towards a reconnect.
+    # If timeout (in s) is given, or defaultTimeout is set, the transaction
+    # must finish by then: waiting for the lock and serial reads are limited
+    # to the time remaining, and CommsTimeout is raised when it runs out.
+    # Nested transactions keep the earlier of their own and the outer
+    # deadline.
+    # Commands are scheduled by priority (see CommandScheduler).
+    # name, if given, is used to time the call as 'method.<name>'.
+    @contextlib.contextmanager
+    def comms(self, timeout=None, priority=NORMAL, name=None):
+        if self.degraded and threading.current_thread() is not self.reconnectThread:
+            raise LaserUnavailable('Device on %s is unavailable; reconnecting.'
+                                   % (self.portArgs[:1] or ('?',)))
+        if (self.commsDepth and timeout is None
+                and self.commsLock.isOwned()):
+            # Nested in a transaction of this thread, which already holds
+            # the lock and sets the deadline: just count the depth.
+            t0 = time.time()
+            self.commsDepth += 1
+            try:
+                yield
+            finally:
+                self.commsDepth -= 1
+                if name is not None:
+                    self.metrics.observe(_methodMetric(name), time.time() - t0)
+            return
+        t0 = time.time()
+        if timeout is None and not self.commsLock.isOwned():
+            timeout = self.defaultTimeout
+        deadline = None if timeout is None else t0 + timeout
+        if not self.commsLock.acquire(timeout=timeout, priority=priority):
+            self.metrics.increment('timeouts.lock')
+            raise CommsTimeout('Timed out after %g s waiting for comms.'
+                               % timeout)
+        if not self.commsDepth:
+            # Responses to earlier transactions will not be matched now.
+            # The device still owes them, ahead of ours.
+            self.staleResponses += len(self.pendingCommands)
+            self.pendingCommands.clear()
+            self.commsMethod = name
+        outerDeadline = self.deadline
+        if deadline is None or (outerDeadline is not None
+                                and outerDeadline < deadline):
+            deadline = outerDeadline
+        self.deadline = deadline
+        self.commsDepth += 1
+        try:
+            yield
+        except COMMS_ERRORS as e:
+            # Count only once, at the outermost transaction.
+            if self.commsDepth == 1:
+                self.metrics.increment('errors.comms')
+                self.noteCommsFailure(str(e))
+            raise
+        finally:
+            self.commsDepth -= 1
+            if not self.commsDepth:
+                self.commsMethod = None
+            self.deadline = outerDeadline
+            self.commsLock.release()
+            if name is not None:
+                self.metrics.observe(_methodMetric(name), time.time() - t0)
+
+
+    ## Let a more urgent command run between the transactions of a sequence
+    # (see CommandScheduler.yieldToUrgent). The deadline, depth and method of
+    # our transaction are set aside meanwhile, so that the urgent command
+    # runs as a transaction of its own. Return True if we yielded.
+    def yieldToUrgent(self):
+        saved = self.deadline, self.commsDepth, self.commsMethod
+        self.deadline, self.commsDepth, self.commsMethod = None, 0, None
+        try:
+            return self.commsLock.yieldToUrgent()
+        finally:
+            self.deadline, self.commsDepth, self.commsMethod = saved
+
+
+    ## Note a command written to the device, to time it to its response.
+    # Derived classes call this from write, once the write has succeeded.
+    def noteWrite(self, command):
+        self.pendingCommands.append((command, time.time()))
+
+
+    ## Set the serial read timeout to the configured value, or to the time
+    # left before the deadline if that is shorter. Derived classes call this
+    # before each read.
+    def applyDeadline(self):
+        timeout = self.readTimeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise CommsTimeout('Comms deadline passed.')
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        if self.connection.timeout != timeout:
+            self.connection.timeout = timeout
+
+
+    ## Note a response read from the device; a line without a terminator
+    # means the read timed out.
+    def noteResponse(self, line):
+        now = time.time()
+        if (not line.endswith('\n') and self.deadline is not None
+                and now >= self.deadline):
+            # Cut short by the caller's deadline, not a device failure. The
+            # response is still owed, so the command stays pending.
+            self.metrics.increment('timeouts.deadline')
+            raise CommsTimeout('Comms deadline passed.')
+        if self.pendingCommands:
+            command, sent = self.pendingCommands.popleft()
+            # Time by command name only, e.g. 'PP' for 'PP7FF'.
+            self.metrics.observe(commandMetric(command), now - sent)
+        if line.endswith('\n'):
+            self.commsFailures = 0
+        else:
+            self.metrics.increment('timeouts.read')
+            self.noteCommsFailure('Read timed out.')
+
+
+    ## Read and discard the responses owed to transactions that were cut
+    # short, which would otherwise be taken as answers to later commands.
+    # readResponse() reads one, returning False if none arrives in time; then
+    # nothing further is owed either. Derived classes call this before
+    # writing the first command of a transaction.
+    def discardStaleResponses(self, readResponse):
+        while self.staleResponses:
+            self.applyDeadline()
+            self.staleResponses -= 1
+            if not readResponse():
+                self.staleResponses = 0
+            self.metrics.increment('discardedResponses')
+
+
+    ## Count a comms failure, and start reconnecting if there are too many.
+    def noteCommsFailure(self, reason):
+        if threading.current_thread() is self.reconnectThread:
+            return
+        self.commsFailures += 1
+        if self.commsFailures >= self.maxCommsFailures and not self.degraded:
+            self.degraded = True
+            self.metrics.increment('degraded')
+            if hasattr(self, 'logger'):
+                self.logger.log("Comms failed (%s); reconnecting." % reason,
+                                ERROR)
+            self.reconnectStop.clear()
+            self.reconnectThread = threading.Thread(target=self._reconnectLoop,
+                                                    name='reconnect')
+            self.reconnectThread.daemon = True
+            self.reconnectThread.start()
+
+
+    def _reconnectLoop(self):
+        while not self.reconnectStop.wait(self.reconnectInterval):
+            try:
+                self.metrics.increment('reconnects')
+                self.reconnect()
+            except Exception as e:
+                self.metrics.increment('reconnectFailures')
+                if hasattr(self, 'logger'):
+                    self.logger.log("Reconnect failed: %s" % e, WARNING)
+                continue
+            self.commsFailures = 0
+            self.degraded = False
+            if hasattr(self, 'logger'):
+                self.logger.log("Reconnected.")
+            return
+
+
+    ## Close and reopen the port, then repeat the connection handshake.
+    def reconnect(self):
+        with self.commsLock:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.invalidateConstants()
+            self.connection = transport.openPort(*self.portArgs,
+                                                 journal=self.journal)
+            # Nothing is owed by the new port.
+            self.pendingCommands.clear()
+            self.staleResponses = 0
+            self._handshake()
+
+
+    ## Stop any reconnection and release the port.
+    def close(self):
+        self.reconnectStop.set()
+        if self.reconnectThread is not None:
+            self.reconnectThread.join()
+            self.reconnectThread = None
+        self.connection.close()
+        if self.journal is not None:
+            self.journal.close()
+
+
+    ## Start recording the raw bytes sent and received, with the calling
+    # method, to filename; see journal.Journal.
+    def startJournal(self, filename):
+        with self.commsLock:
+            self.stopJournal()
+            self.journal = journal.Journal(filename,
+                                           lambda: self.commsMethod)
+            self.connection = self.journal.wrap(self.connection)
+
+
+    ## Stop recording raw transfers.
+    def stopJournal(self):
+        with self.commsLock:
+            if self.journal is None:
+                return
+            if isinstance(self.connection, journal.JournalledPort):
+                self.connection = self.connection.port
+            self.journal.close()
+            self.journal = None
+
+
+    ## Return comms scheduler metrics: queue depth, wait and hold times.
+    def getCommsStats(self):
+        return self.commsLock.getStats()
+
+
+    ## Set the response cache time-to-live in s for each named query, e.g.
+    # {'isOn': 0.05, 'power': 0.05, 'status': 0.2}. Queries named with a TTL
+    # of 0 are coalesced but not cached; unnamed queries are neither.
+    def setCacheTTL(self, ttls):
+        self.responseCache.ttl = dict((name, float(ttl))
+                                      for name, ttl in ttls.iteritems())
+        self.responseCache.invalidate()
+
+
+    ## Return response cache hit, miss and coalesced counts.
+    def getCacheStats(self):
+        return self.responseCache.getStats()
+
+
+    ## Return timers (method calls, serial commands, lock wait and hold) as
+    # histograms, counters (timeouts, errors, reconnects) and scheduler stats.
+    def getMetrics(self):
+        snapshot = self.metrics.snapshot()
+        snapshot['scheduler'] = self.commsLock.getStats()
+        return snapshot
+
+
+    ## Return True if the device is degraded and being reconnected.
+    def getIsDegraded(self):
+        return self.degraded
+
+
+    ## Query the device for facts that do not change while it is connected.
+    # Return a dict; keys used by this class are 'maxPower_mW', 'serialNumber',
+    # 'model' and 'firmware'. Derived classes should lock comms as required.
+    @abc.abstractmethod
+    def _readConstants(self):
+        return {}
+
+
+    ## Read and cache the device constants.
+    # Derived classes call this once the connection is open; it should be
+    # called again after a reconnect or fault clear.
+    def refreshConstants(self):
+        self.constants = self._readConstants()
+        return dict(self.constants)
+
+
+    ## Discard cached device constants; they are re-read on next use.
+    def invalidateConstants(self):
+        self.constants = {}
+
+
+    ## Return a cached device constant, reading the constants if necessary.
+    def getConstant(self, name):
+        if not self.constants:
+            self.refreshConstants()
+        return self.constants.get(name)
+
+
+    ## Return all cached device constants.
+    def getConstants(self):
+        if not self.constants:
+            self.refreshConstants()
+        return dict(self.constants)
+
+
+    ## Start a thread that refreshes the status snapshot every interval s.
+    # If serve is False, the snapshot is only used to detect events, and
+    # getters still query the device.
+    def startPoller(self, interval, serve=True):
+        self.stopPoller()
+        self.pollInterval = float(interval)
+        self.serveSnapshot = serve
+        self.pollerStop.clear()
+        self.pollerThread = threading.Thread(target=self._pollLoop,
+                                             name='poller-%s' % id(self))
+        self.pollerThread.daemon = True
+        self.pollerThread.start()
+
+
+    ## Stop the status poller; getters go back to querying the device.
+    def stopPoller(self):
+        if self.pollerThread is None:
+            return
+        self.serveSnapshot = False
+        self.pollerStop.set()
+        self.pollerThread.join()
+        self.pollerThread = None
+        self.pollInterval = None
+
+
+    def _pollLoop(self):
+        while not self.pollerStop.is_set():
+            self.pollStatus()
+            self.pollerStop.wait(self.pollInterval)
+
+
+    ## Query the device once and publish a new status snapshot.
+    def pollStatus(self):
+        snapshot = dict(self.snapshot)
+        generation = self.snapshotGeneration
+        try:
+            values = {key: getter()
+                      for key, getter in self.snapshotSources.iteritems()}
+        except Exception as e:
+            # Keep the last good values, but record the failure.
+            snapshot['error'] = str(e)
+        else:
+            snapshot.update(values)
+            snapshot.pop('error', None)
+            snapshot['time'] = time.time()
+            snapshot['generation'] = generation
+        self._publishChanges(self.snapshot, snapshot)
+        self.snapshot = snapshot
+        return snapshot
+
+
+    ## Mark the status snapshot stale, so that getters query the device
+    # until the next poll.
+    def invalidateSnapshot(self):
+        self.snapshotGeneration = next(self.snapshotGenerations)
+
+
+    ## Publish events for state changes between two snapshots.
+    def _publishChanges(self, old, new):
+        if 'error' in new and 'error' not in old:
+            self.events.publish(events.COMMS_LOST, new['error'])
+        elif 'error' in old and 'error' not in new:
+            self.events.publish(events.COMMS_RESTORED, None)
+        if 'error' in new:
+            return
+        if old.get('isOn') != new['isOn']:
+            self.events.publish(events.EMISSION, new['isOn'])
+        if old.get('fault') != new['fault'] and (old or new['fault']):
+            self.events.publish(events.FAULT, new['fault'])
+
+
+    ## Subscribe a callback to state-change events (emission, fault, comms
+    # lost/restored). The callback may be a Pyro proxy for an object with an
+    # onLaserEvent(event) method. Starts the poller, to detect events only,
+    # if it is not running.
+    def subscribe(self, callback):
+        if self.pollerThread is None:
+            self.startPoller(self.eventPollInterval, serve=False)
+        self.events.subscribe(callback)
+
+
+    def unsubscribe(self, callback):
+        self.events.unsubscribe(callback)
+
+
+    ## Return events with id > sinceId, waiting up to timeout s for one.
+    # Starts the poller, to detect events only, if it is not running.
+    def getEvents(self, sinceId=0, timeout=0):
+        if self.pollerThread is None:
+            self.startPoller(self.eventPollInterval, serve=False)
+        return self.events.getEvents(sinceId, timeout)
+
+
+    ## Return the latest status snapshot with its age in seconds.
+    # The age is None if no successful poll has completed yet.
+    def getSnapshot(self):
+        snapshot = dict(self.snapshot)
+        if 'time' in snapshot:
+            snapshot['age'] = time.time() - snapshot['time']
+        else:
+            snapshot['age'] = None
+        return snapshot
+
+
+    ## Start a power sequence, run on the server with accurate timing.
+    # points is a list of (time, mW), times in s from the start; or waveform
+    # is a dict of arguments to sequencer.makeWaveform, e.g.
+    #   {'shape': 'ramp', 'low': 0, 'high': 50, 'duration': 2, 'steps': 20}
+    # The sequence starts after delay s; this call returns immediately.
+    def startSequence(self, points=None, waveform=None, delay=0):
+        if waveform is not None:
+            points = sequencer.makeWaveform(**waveform)
+        self.sequencer.start(points, delay)
+
+
+    ## Stop any running power sequence.
+    def stopSequence(self):
+        self.sequencer.stop()
+
+
+    ## Return progress and requested vs. achieved timing of the sequence.
+    def getSequenceStatus(self):
+        return self.sequencer.getStatus()
+
+
+    ## Start holding measured power at the set point, sampling every
+    # interval s; see stabiliser.Stabiliser for the other arguments.
+    def startStabiliser(self, interval=1., gain=0.5, maxCorrection=0.2,
+                        tolerance=0.01):
+        self.stabiliser.stop()
+        self.stabiliser.interval = float(interval)
+        self.stabiliser.gain = float(gain)
+        self.stabiliser.maxCorrection = float(maxCorrection)
+        self.stabiliser.tolerance = float(tolerance)
+        self.stabiliser.start()
+
+
+    ## Stop the stabiliser, leaving the last corrected power in place.
+    def stopStabiliser(self):
+        self.stabiliser.stop()
+
+
+    ## Return settling time, residual error and state of the stabiliser.
+    def getStabiliserStatus(self):
+        return self.stabiliser.getStatus()
+
+
+    ## Return a telemetry sample as a dict with keys 'power_mW', 'isOn',
+    # 'fault' and 'hours'. Derived classes should override this to read
+    # fault state and head hours where the device reports them.
+    def readTelemetry(self):
+        return {'power_mW': self.getPower_mW(),
+                'isOn': self.getIsOn(),
+                'fault': telemetry.NO_FAULT_INFO,
+                'hours': float('nan')}
+
+
+    ## Start sampling telemetry every interval s into ring buffers holding
+    # capacity samples, and append the samples to filename if given.
+    def startTelemetry(self, interval, filename=None, capacity=36000):
+        self.stopTelemetry()
+        self.telemetry = telemetry.Recorder(self.readTelemetry, interval,
+                                            capacity, filename)
+        self.telemetry.start()
+
+
+    def stopTelemetry(self):
+        if self.telemetry is not None:
+            self.telemetry.stop()
+
+
+    ## Return telemetry samples with start <= time < end, as a dict of
+    # 'dtype' (a numpy dtype description) and 'data' (the packed records).
+    def getTelemetry(self, start=0, end=float('inf')):
+        if self.telemetry is None:
+            raise Exception('Telemetry is not being recorded.')
+        return self.telemetry.getWindow(start, end)
+
+
+    ## Send several commands and return their responses in order.
+    # If the device can pipeline, all commands are written back-to-back and
+    # the responses read in one pass; otherwise each command waits for its
+    # response before the next is sent.
+    def queryMany(self, commands):
+        with self.comms():
+            if not self.canPipeline:
+                responses = []
+                for command in commands:
+                    # Let emission off etc. in between transactions.
+                    if responses:
+                        self.yieldToUrgent()
+                    self.write(command)
+                    responses.append(self.readline())
+                return responses
+            for command in commands:
+                self.write(command)
+            return [self.readline() for command in commands]
+
+
+    ## Send the protocol command called name, formatted with args, and
+    # return its response as a value; see protocol.Command.
+    def command(self, name, *args):
+        return self.commandMany([(name,) + args])[0]
+
+
+    ## Send several protocol commands in one transaction and return their
+    # responses as values, or as strings if not convert. Each step is a
+    # command name, or a tuple of name and arguments.
+    def commandMany(self, steps, convert=True):
+        commands = []
+        strings = []
+        for step in steps:
+            if isinstance(step, basestring):
+                step = (step,)
+            command = self.protocol[step[0]]
+            commands.append(command)
+            strings.append(command.format(*step[1:]))
+        responses = self.queryMany(strings)
+        if not convert:
+            return responses
+        return [command.decode(response)
+                for command, response in zip(commands, responses)]
 
 
     ## Simple passthrough.
@@ -121,10 +1268,15 @@ class Laser(object):
         pass
 
 
+    ## Return the fault state reported by the device, or None if the device
+    # does not report faults. Zero or False means no fault.
+    def getFault(self):
+        return None
+
+
     ## Return the max. power in mW.
-    @abc.abstractmethod
     def getMaxPower_mW(self):
-        pass
+        return self.getConstant('maxPower_mW')
 
 
     ## Return the current power in mW.
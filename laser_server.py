@@ -15,8 +15,15 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import ConfigParser
+import drivers
+import journal
+import metrics
+import multiprocessing
+import os
 import serial
 import socket
+import telemetry
 import threading
 import time
 import Pyro4
@@ -25,82 +32,752 @@ CONFIG_NAME = 'laserServer'
 Pyro4.config.SERIALIZER = 'pickle'
 Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
 
+
+## Call func(item) for each item, each in its own thread.
+# Return (results, failures), dicts keyed by item. An item whose call raises,
+# or has not returned after timeout seconds, goes in failures with a
+# description of the error; a timed-out thread is left to finish on its own.
+# If late is given, late(result) is called for a timed-out call that returns
+# after all, e.g. to release what it opened.
+def runParallel(func, items, timeout, late=None):
+    results = {}
+    failures = {}
+    # Items given up on, and a lock so that a call cannot finish unnoticed
+    # while it is being given up on.
+    abandoned = set()
+    lock = threading.Lock()
+    def target(item):
+        try:
+            result = func(item)
+        except Exception as e:
+            with lock:
+                if item not in abandoned:
+                    failures[item] = '%s: %s' % (type(e).__name__, e)
+            return
+        with lock:
+            if item not in abandoned:
+                results[item] = result
+                return
+        if late is not None:
+            try:
+                late(result)
+            except Exception as e:
+                print "\tLate result for %s could not be released: %s: %s" % (
+                        item, type(e).__name__, e)
+    threads = {}
+    for item in items:
+        thread = threading.Thread(target=target, args=(item,),
+                                  name='parallel-%s' % (item,))
+        thread.daemon = True
+        thread.start()
+        threads[item] = thread
+    deadline = time.time() + timeout
+    for item, thread in threads.iteritems():
+        thread.join(max(deadline - time.time(), 0))
+        with lock:
+            if item not in results and item not in failures:
+                abandoned.add(item)
+                failures[item] = 'Timed out after %g s.' % timeout
+    return dict(results), dict(failures)
+
+
+## Stop everything a laser is doing, switch emission off, and release its
+# port and log file. The port and log are released even if switching off
+# fails (e.g. the laser is degraded), which also stops any reconnection.
+def closeDevice(device):
+    try:
+        device.stopSequence()
+        device.stopStabiliser()
+        device.stopPoller()
+        device.stopTelemetry()
+        device.disable()
+    finally:
+        try:
+            device.close()
+        finally:
+            # Write out any queued log messages.
+            device.logger.close()
+
+
+## Call prepare(item) for each item, each in its own thread, then release
+# all the threads at once to call run(item, prepared) and return
+# (results, failures, times), dicts keyed by item. times maps an item to the
+# (start, end) of its run, in s from the release. Threads are released once
+# all are prepared, or after timeout s; Python 2 has no threading.Barrier,
+# so the start gate is an Event.
+def runTogether(prepare, run, items, timeout):
+    results = {}
+    failures = {}
+    times = {}
+    ready = threading.Condition()
+    prepared = [0]
+    release = threading.Event()
+    released = [None]
+    def target(item):
+        try:
+            state = prepare(item)
+        except Exception as e:
+            failures[item] = '%s: %s' % (type(e).__name__, e)
+            state = None
+        with ready:
+            prepared[0] += 1
+            ready.notify()
+        release.wait()
+        if item in failures:
+            return
+        start = time.time()
+        try:
+            results[item] = run(item, state)
+        except Exception as e:
+            failures[item] = '%s: %s' % (type(e).__name__, e)
+        times[item] = (start - released[0], time.time() - released[0])
+    threads = {}
+    for item in items:
+        thread = threading.Thread(target=target, args=(item,),
+                                  name='together-%s' % (item,))
+        thread.daemon = True
+        thread.start()
+        threads[item] = thread
+    deadline = time.time() + timeout
+    with ready:
+        while prepared[0] < len(threads) and time.time() < deadline:
+            ready.wait(deadline - time.time())
+    released[0] = time.time()
+    release.set()
+    deadline = time.time() + timeout
+    for item, thread in threads.iteritems():
+        thread.join(max(deadline - time.time(), 0))
+        if thread.is_alive():
+            failures[item] = 'Timed out after %g s.' % timeout
+    return dict(results), dict(failures), dict(times)
+
+
+## Use the serializer named in config for Pyro calls made from this process
+# (e.g. event callbacks), and accept it from clients as well as pickle.
+# marshal has the least overhead for small replies.
+def configureSerializer(config):
+    try:
+        serializer = config.get(CONFIG_NAME, 'serializer')
+    except:
+        return
+    Pyro4.util.get_serializer(serializer)
+    Pyro4.config.SERIALIZER = serializer
+    Pyro4.config.SERIALIZERS_ACCEPTED.add(serializer)
+
+
+# The metrics.Metrics that instrumented serializers record into.
+serializer_metrics = None
+
+
+## Time Pyro (de)serialisation on the server into a metrics.Metrics.
+# Wraps the methods of the shared serializer instances, so this also times
+# any Pyro clients in the same process. Each method is wrapped only once;
+# later calls (e.g. for another server in the same process) just point the
+# wrappers at the new metrics.
+def instrumentSerializers(server_metrics):
+    global serializer_metrics
+    serializer_metrics = server_metrics
+    def timed(name, method):
+        def wrapper(*args, **kwargs):
+            with serializer_metrics.timer(name):
+                return method(*args, **kwargs)
+        wrapper.instrumented = True
+        return wrapper
+    for serializer_name in Pyro4.config.SERIALIZERS_ACCEPTED:
+        try:
+            serializer = Pyro4.util.get_serializer(serializer_name)
+        except Exception:
+            continue
+        for method in ('deserializeCall', 'serializeData'):
+            original = getattr(serializer, method)
+            if getattr(original, 'instrumented', False):
+                continue
+            setattr(serializer, method, timed(
+                    'pyro.%s.%s' % (serializer_name, method), original))
+
+
+## Write text to filename, replacing it in one step so that readers never
+# see a partial file.
+def writeFile(filename, text):
+    temp = filename + '.tmp'
+    with open(temp, 'w') as fh:
+        fh.write(text)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(temp, filename)
+
+
+## Print a failure report from runParallel.
+def reportFailures(action, failures):
+    for item, error in sorted(failures.iteritems()):
+        print "\t%s failed for %s: %s" % (action, item, error)
+
+
+## Return worker groups from the workers option, as lists of sections.
+# 'each' puts every laser in its own worker; otherwise groups are separated
+# by spaces and the sections in a group by commas, e.g.
+# 'deepstar405,deepstar488 cobolt561'. Unlisted lasers get a worker each.
+def parseWorkers(value, sections):
+    if value.strip() == 'each':
+        return [[section] for section in sorted(sections)]
+    groups = [[section for section in group.split(',') if section]
+              for group in value.split()]
+    listed = set(section for group in groups for section in group)
+    unknown = listed - set(sections)
+    if unknown:
+        raise Exception('Unknown laser sections in workers: %s.'
+                        % ', '.join(sorted(unknown)))
+    return groups + [[section] for section in sorted(set(sections) - listed)]
+
+
+## Run a Server for some lasers in this process until stop is set.
+# config maps sections to {option: value}, so that it can be passed to a new
+# process on any platform.
+def runWorker(config, stop):
+    parser = ConfigParser.RawConfigParser()
+    for section, options in config.iteritems():
+        parser.add_section(section)
+        for option, value in options.iteritems():
+            parser.set(section, option, value)
+    server = Server(parser)
+    def waitForStop():
+        stop.wait()
+        server.stop()
+    thread = threading.Thread(target=waitForStop, name='worker-stop')
+    thread.daemon = True
+    thread.start()
+    server.run()
+
+
+## Runs groups of lasers in worker processes, each with its own Pyro daemon
+# on its own port, and restarts workers that die. Served by the parent
+# process as 'laserServer', to publish where each laser is served.
+class WorkerSupervisor(object):
+    def __init__(self, config, groups, host, port, restartInterval=2.):
+        self.host = host
+        self.restartInterval = restartInterval
+        self.stopping = False
+        serverOptions = dict(config.items(CONFIG_NAME))
+        serverOptions.pop('workers', None)
+        self.workers = []
+        for i, sections in enumerate(groups):
+            name = 'worker%d' % i
+            workerConfig = dict((section, dict(config.items(section)))
+                                for section in sections)
+            workerConfig[CONFIG_NAME] = dict(serverOptions)
+            workerConfig[CONFIG_NAME]['port'] = str(port + 1 + i)
+            # Each worker dumps its own metrics.
+            if 'metricsfile' in serverOptions:
+                base, ext = os.path.splitext(serverOptions['metricsfile'])
+                workerConfig[CONFIG_NAME]['metricsfile'] = '%s.%s%s' % (
+                        base, name, ext)
+            self.workers.append({'name': name, 'sections': sections,
+                                 'port': port + 1 + i, 'config': workerConfig,
+                                 'process': None, 'stop': None,
+                                 'started': None, 'restarts': 0})
+
+
+    def _startWorker(self, worker):
+        worker['stop'] = multiprocessing.Event()
+        worker['process'] = multiprocessing.Process(
+                target=runWorker, name=worker['name'],
+                args=(worker['config'], worker['stop']))
+        worker['process'].start()
+        worker['started'] = time.time()
+
+
+    def start(self):
+        for worker in self.workers:
+            self._startWorker(worker)
+            print "\t%s (pid %d) serving %s on port %d" % (
+                    worker['name'], worker['process'].pid,
+                    ' '.join(worker['sections']), worker['port'])
+
+
+    ## Restart any worker that has died, at most once per restartInterval.
+    def check(self):
+        for worker in self.workers:
+            process = worker['process']
+            if self.stopping or process.is_alive():
+                continue
+            if time.time() - worker['started'] < self.restartInterval:
+                continue
+            print "\t%s exited with code %s; restarting." % (
+                    worker['name'], process.exitcode)
+            worker['restarts'] += 1
+            self._startWorker(worker)
+
+
+    ## Ask workers to shut down their lasers, waiting up to timeout s before
+    # terminating them.
+    def stop(self, timeout):
+        self.stopping = True
+        for worker in self.workers:
+            worker['stop'].set()
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            worker['process'].join(max(deadline - time.time(), 0))
+            if worker['process'].is_alive():
+                print "\t%s did not stop; terminating." % worker['name']
+                worker['process'].terminate()
+                worker['process'].join()
+
+
+    ## Return a map of Pyro names to URIs: for each laser, and for each
+    # worker's laserServer group object.
+    def getURIs(self):
+        uris = {}
+        for worker in self.workers:
+            for name in worker['sections'] + [CONFIG_NAME]:
+                uri = 'PYRO:%s@%s:%d' % (name, self.host, worker['port'])
+                if name == CONFIG_NAME:
+                    name = '%s.%s' % (CONFIG_NAME, worker['name'])
+                uris[name] = uri
+        return uris
+
+
+    ## Return the state of each worker process.
+    def getWorkers(self):
+        return dict((worker['name'],
+                     {'sections': worker['sections'],
+                      'port': worker['port'],
+                      'pid': worker['process'].pid,
+                      'alive': worker['process'].is_alive(),
+                      'restarts': worker['restarts']})
+                    for worker in self.workers)
+
+
+## Stands in for a laser until a client first uses it, so that the server
+# starts without opening the port. Pyro finds methods on the class, so
+# makeLazyDevice makes a subclass with the public methods of the laser class,
+# each of which creates the laser (by calling create) and calls through.
+class LazyDevice(object):
+    def __init__(self, create):
+        self._create = create
+        self._device = None
+        self._lock = threading.Lock()
+
+
+    ## Return the laser, creating it on first use.
+    def _getDevice(self):
+        with self._lock:
+            if self._device is None:
+                self._device = self._create()
+            return self._device
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._getDevice(), name)
+
+
+## Return a LazyDevice for a laser of class cls, made by create().
+def makeLazyDevice(cls, create):
+    def delegate(name):
+        def method(self, *args, **kwargs):
+            return getattr(self._getDevice(), name)(*args, **kwargs)
+        method.__name__ = name
+        return method
+    methods = dict((name, delegate(name)) for name in dir(cls)
+                   if not name.startswith('_')
+                   and callable(getattr(cls, name)))
+    lazyClass = type('Lazy' + cls.__name__, (LazyDevice,), methods)
+    return lazyClass(create)
+
+
+## Return device, or the laser behind it if it is a LazyDevice, or None if
+# that laser has not been created.
+def openedDevice(device):
+    if isinstance(device, LazyDevice):
+        return device._device
+    return device
+
+
+## A Pyro object for operations on all the lasers served.
+class LaserGroup(object):
+    def __init__(self, devices, timeout, server_metrics=None):
+        # Map Pyro names to laser instances.
+        self.devices = devices
+        self.timeout = timeout
+        # Server-wide metrics, e.g. Pyro serialisation times.
+        self.metrics = server_metrics or metrics.Metrics()
+        # Lasers that could not be created, mapped to the error.
+        self.failures = {}
+        # Start-up timings; see Server.run.
+        self.startupTimes = {}
+
+
+    ## Return the lasers that failed to start and why.
+    def getFailures(self):
+        return dict(self.failures)
+
+
+    ## Return the time taken to start the server and its parts, in s.
+    def getStartupTimes(self):
+        return dict(self.startupTimes)
+
+
+    ## Return metrics for each laser, and for the server as 'laserServer'.
+    # Lasers that are opened lazily and not yet used are left out.
+    def getMetrics(self):
+        result = dict((name, openedDevice(device).getMetrics())
+                      for name, device in self.devices.iteritems()
+                      if openedDevice(device) is not None)
+        result[CONFIG_NAME] = self.metrics.snapshot()
+        return result
+
+
+    ## Return all metrics in the Prometheus text format.
+    def getMetricsText(self):
+        return metrics.formatText(self.getMetrics())
+
+
+    ## Return {name: (power_mW, isOn, setPower_mW)} for all lasers in one
+    # call, reading the lasers concurrently. A laser that fails maps to None.
+    def getPowerStates(self):
+        def read(name):
+            device = self.devices[name]
+            return (device.getPower_mW(), device.getIsOn(),
+                    device.getSetPower_mW())
+        results, failures = runParallel(read, self.devices, self.timeout)
+        for name in failures:
+            results[name] = None
+        return results
+
+
+    ## Run steps on several lasers at once, so that they act together.
+    # commands maps laser names to lists of (method, args) steps, e.g.
+    #   {'deepstar405': [('setPower_mW', (5,)), ('enable', ())], ...}
+    # Each laser runs its steps in order on its own thread, and all start
+    # together once every laser is ready. Return a dict with, for each laser,
+    # its step results, error (or None) and start and end times in s from
+    # the common start, and 'startSkew' and 'endSkew', the spread of those
+    # times over the lasers.
+    def runGroupCommand(self, commands):
+        def prepare(name):
+            if name not in self.devices:
+                raise Exception("No laser called '%s'." % name)
+            # Open a lazily opened laser now rather than after the start.
+            device = self.devices[name]
+            if isinstance(device, LazyDevice):
+                device = device._getDevice()
+            steps = []
+            for method, args in commands[name]:
+                if method.startswith('_'):
+                    raise Exception("Cannot call '%s'." % method)
+                steps.append((getattr(device, method), args))
+            return steps
+        def run(name, steps):
+            return [method(*args) for method, args in steps]
+        results, failures, times = runTogether(prepare, run, commands,
+                                               self.timeout)
+        lasers = {}
+        for name in commands:
+            start, end = times.get(name, (None, None))
+            lasers[name] = {'results': results.get(name),
+                            'error': failures.get(name),
+                            'start': start, 'end': end}
+        starts = [start for start, end in times.itervalues()]
+        ends = [end for start, end in times.itervalues()]
+        return {'lasers': lasers,
+                'startSkew': max(starts) - min(starts) if starts else None,
+                'endSkew': max(ends) - min(ends) if ends else None}
+
+
+    ## Set the power of several lasers together, and optionally switch them
+    # on. powers maps laser names to mW. See runGroupCommand.
+    def setPowers(self, powers, enable=False):
+        commands = {}
+        for name, mW in powers.iteritems():
+            commands[name] = [('setPower_mW', (mW,))]
+            if enable:
+                commands[name].append(('enable', ()))
+        return self.runGroupCommand(commands)
+
+
+    ## Switch several lasers (all, if names is None) off together.
+    def disableAll(self, names=None):
+        if names is None:
+            names = self.devices.keys()
+        return self.runGroupCommand(dict((name, [('disable', ())])
+                                         for name in names))
+
+
+    ## Run onCockpitInitialize on all lasers concurrently.
+    # Return a dict of lasers that failed, mapped to the error.
+    def onCockpitInitialize(self):
+        def initialize(name):
+            device = self.devices[name]
+            if hasattr(device, 'onCockpitInitialize'):
+                device.onCockpitInitialize()
+        results, failures = runParallel(initialize, self.devices, self.timeout)
+        reportFailures('onCockpitInitialize', failures)
+        return failures
+
+
 class Server(object):
-    def __init__(self):
+    def __init__(self, config=None):
         self.run_flag = True
+        # Set by stop() to wake run() for shutdown.
+        self.stop_event = threading.Event()
         self.devices = {}
         self.daemon_thread = None
+        # A ConfigParser to use instead of readconfig.config.
+        self.config = config
+        # Set once the Pyro daemon is serving.
+        self.ready = threading.Event()
 
 
     def run(self):
-        import readconfig
-        config = readconfig.config
+        t_start = time.time()
+        config = self.config
+        if config is None:
+            import readconfig
+            config = readconfig.config
         try:
-            supported_lasers = config.get(CONFIG_NAME, 'supported').split(' ')
+            supported_lasers = config.get(CONFIG_NAME, 'supported').split()
         except:
             raise Exception('No supported laser modules defined in config.')
 
-        loaded_modules = {}
+        # Map lasers defined in config to their driver.
+        lasers = {}
+        for section in config.sections():
+            driver = drivers.driverFor(section, supported_lasers)
+            if driver is not None:
+                lasers[section] = driver
+
+        # Per-device limit on start-up and shutdown steps.
+        try:
+            self.device_timeout = float(config.get(CONFIG_NAME, 'deviceTimeout'))
+        except:
+            self.device_timeout = 10.
+
+        port = config.get(CONFIG_NAME, 'port')
+        host = config.get(CONFIG_NAME, 'ipAddress')
+
+        # Optionally run the lasers in worker processes, and supervise them.
+        try:
+            workers = config.get(CONFIG_NAME, 'workers')
+        except:
+            workers = None
+        if workers:
+            self.supervise(config, parseWorkers(workers, lasers),
+                           host, int(port))
+            return
+
+        # Import only the drivers that config uses.
         print "Loading laser modules:"
-        for module in supported_lasers:
-            try:
-                m = __import__(module)
-                print "\t%s loaded" % module
-            except:
-                raise Exception("Could not load module %s." % module)
-            loaded_modules.update({module: m})
+        for driver in sorted(set(lasers.itervalues())):
+            drivers.load(driver)
+            print "\t%s loaded" % driver
 
-        # Map lasers defined in config to their driver module.
-        lasers = {section: module_name
-                    for section in config.sections() 
-                    for module_name in supported_lasers
-                    if section.startswith(module_name)}
+        # Time taken to create each laser, in s.
+        create_times = {}
 
-        # Create laser instances and map to Pyro names.
-        for section, module_name in lasers.iteritems():
+        def create(section):
+            t0 = time.time()
             com = config.get(section, 'comPort')
             baud = config.get(section, 'baud')
             try:
                 timeout = config.get(section, 'timeout')
             except:
                 timeout = 1.
-            # Create an instance of the laser m.CLASS_NAME in module m.
-            m = loaded_modules[module_name]
-            laser_instance = getattr(m, m.CLASS_NAME)(com, int(baud), int(timeout))
-            
-            # Add this to the dict mapping lasers to Pyro names.
+            # Create an instance of the laser class of the driver.
+            laser_class = drivers.getClass(lasers[section])
+            laser_instance = laser_class(com, int(baud), int(timeout))
+            # Optionally send batched commands without waiting for replies.
+            try:
+                laser_instance.canPipeline = config.getboolean(section,
+                                                               'pipeline')
+            except:
+                pass
+            # Optionally limit how long a client call may wait for comms.
+            try:
+                call_timeout = config.get(section, 'callTimeout')
+            except:
+                call_timeout = None
+            if call_timeout:
+                laser_instance.defaultTimeout = float(call_timeout)
+            # Optionally cache query responses, e.g. 'isOn:0.05 status:0.2'.
+            try:
+                cache_ttl = config.get(section, 'cacheTTL')
+            except:
+                cache_ttl = None
+            if cache_ttl:
+                laser_instance.setCacheTTL(dict(item.split(':')
+                                                for item in cache_ttl.split()))
+            # Optionally serve status getters from a background poller.
+            try:
+                poll_interval = config.get(section, 'pollInterval')
+            except:
+                poll_interval = None
+            if poll_interval:
+                laser_instance.startPoller(float(poll_interval))
+            # Optionally hold measured power at the set point.
+            try:
+                stabilise_interval = config.get(section, 'stabiliseInterval')
+            except:
+                stabilise_interval = None
+            if stabilise_interval:
+                options = {}
+                for option, name in (('stabiliseGain', 'gain'),
+                                     ('stabiliseLimit', 'maxCorrection'),
+                                     ('stabiliseTolerance', 'tolerance')):
+                    if config.has_option(section, option):
+                        options[name] = float(config.get(section, option))
+                laser_instance.startStabiliser(float(stabilise_interval),
+                                               **options)
+            # Optionally record raw serial traffic to <section>.jnl or a file.
+            try:
+                journal_file = config.get(section, 'journal')
+            except:
+                journal_file = None
+            if journal_file in ('0', 'no', 'false', 'off'):
+                journal_file = None
+            elif journal_file in ('1', 'yes', 'true', 'on'):
+                journal_file = journal.defaultFilename(section)
+            if journal_file:
+                laser_instance.startJournal(journal_file)
+            # Optionally record telemetry to <section>.tel.
+            try:
+                telemetry_interval = config.get(section, 'telemetryInterval')
+            except:
+                telemetry_interval = None
+            if telemetry_interval:
+                laser_instance.startTelemetry(float(telemetry_interval),
+                                              telemetry.defaultFilename(section))
+            create_times[section] = time.time() - t0
+            return laser_instance
+
+        # Lasers may be opened on first use rather than now, if lazyOpen is
+        # set in their section or in the laserServer section.
+        def isLazy(section):
+            for s in (section, CONFIG_NAME):
+                if config.has_option(s, 'lazyOpen'):
+                    return config.getboolean(s, 'lazyOpen')
+            return False
+        lazy = [section for section in lasers if isLazy(section)]
+
+        # Create laser instances concurrently, so that a device that is slow
+        # or dead does not hold up the others, and map them to Pyro names.
+        t0 = time.time()
+        # A laser that is created after the timeout is not served, so close
+        # it rather than leave its port open.
+        instances, failures = runParallel(
+                create, [section for section in lasers if section not in lazy],
+                self.device_timeout, late=closeDevice)
+        t_create = time.time() - t0
+        reportFailures('Start-up', failures)
+        for section in lazy:
+            instances[section] = makeLazyDevice(
+                    drivers.getClass(lasers[section]),
+                    lambda section=section: create(section))
+        for section, laser_instance in instances.iteritems():
             self.devices.update({laser_instance: section})
+        self.group = LaserGroup(instances, self.device_timeout)
+        self.group.failures = failures
+        self.group.startupTimes = {'imports': drivers.getLoadTimes(),
+                                   'devices': create_times,
+                                   'create': t_create,
+                                   'lazy': lazy}
+        configureSerializer(config)
+        instrumentSerializers(self.group.metrics)
 
-        port = config.get(CONFIG_NAME, 'port')
-        host = config.get(CONFIG_NAME, 'ipAddress')
+        # Optionally dump metrics to a text file for a local scraper.
+        try:
+            metrics_file = config.get(CONFIG_NAME, 'metricsFile')
+        except:
+            metrics_file = None
+        try:
+            metrics_interval = float(config.get(CONFIG_NAME, 'metricsInterval'))
+        except:
+            metrics_interval = 10.
+
+        # Pyro server type: 'thread' (a worker thread per connection, from a
+        # pool) or 'multiplex' (one thread; calls into lasers are serialised).
+        try:
+            Pyro4.config.SERVERTYPE = config.get(CONFIG_NAME, 'serverType')
+        except:
+            pass
+        try:
+            Pyro4.config.THREADPOOL_SIZE = int(
+                    config.get(CONFIG_NAME, 'threadPoolSize'))
+        except:
+            pass
 
-        self.daemon = Pyro4.Daemon(port=int(port), host=host)
+        # Serve the lasers and the group object.
+        objects = dict(self.devices)
+        objects[self.group] = CONFIG_NAME
+        self.serve(objects, host, int(port))
+        self.group.startupTimes['total'] = time.time() - t_start
+        print "Started in %.3f s (imports %.3f s, devices %.3f s)." % (
+                self.group.startupTimes['total'],
+                sum(drivers.getLoadTimes().itervalues()), t_create)
+
+        # Wait until stop() is called, waking only to dump metrics.
+        while self.run_flag:
+            if metrics_file:
+                writeFile(metrics_file, self.group.getMetricsText())
+                self.stop_event.wait(metrics_interval)
+            else:
+                self.stop_event.wait()
+
+        # Do any cleanup.
+        self.daemon.shutdown()
+        self.daemon_thread.join()
+
+        # For each laser, concurrently ...
+        def shutdown(device):
+            # ... skip lasers that were to be opened lazily but never used
+            device = openedDevice(device)
+            if device is None:
+                return
+            # ... switch emission off and release the port.
+            closeDevice(device)
+        results, failures = runParallel(shutdown, self.devices,
+                                        self.device_timeout)
+        reportFailures('Shutdown', dict((self.devices[device], error)
+                                        for device, error in failures.iteritems()))
+
+
+    ## Start a Pyro daemon serving objects (a map of instances to names).
+    def serve(self, objects, host, port):
+        self.daemon = Pyro4.Daemon(port=port, host=host)
         # Start the daemon in a new thread.
         self.daemon_thread = threading.Thread(
             target=Pyro4.Daemon.serveSimple,
-            args = (self.devices, ), # our mapping of class instances to names
+            args = (objects, ), # our mapping of class instances to names
             kwargs = {'daemon': self.daemon, 'ns': False}
             )
         self.daemon_thread.start()
+        self.ready.set()
 
-        # Wait until run_flag is set to False.
-        while self.run_flag:
-            time.sleep(1)
 
-        # Do any cleanup.
+    ## Run groups of lasers in worker processes until stop() is called,
+    # serving a WorkerSupervisor that maps laser names to URIs.
+    def supervise(self, config, groups, host, port):
+        try:
+            restart_interval = float(config.get(CONFIG_NAME, 'restartInterval'))
+        except:
+            restart_interval = 2.
+        self.supervisor = WorkerSupervisor(config, groups, host, port,
+                                           restart_interval)
+        print "Starting worker processes:"
+        self.supervisor.start()
+        self.serve({self.supervisor: CONFIG_NAME}, host, port)
+        while self.run_flag:
+            self.supervisor.check()
+            self.stop_event.wait(1.)
         self.daemon.shutdown()
         self.daemon_thread.join()
-
-        # For each laser ...
-        for (device, name) in self.devices.iteritems():
-            # ... make sure emission is switched off
-            device.disable()
-            # ... relase the COM port.
-            device.connection.close()
+        # Workers shut their lasers down concurrently.
+        self.supervisor.stop(2 * self.device_timeout)
 
 
     def stop(self):
         self.run_flag = False
+        self.stop_event.set()
 
 if __name__ == "__main__":
     ## Only run when called as a script --- do not run on include.
@@ -0,0 +1,108 @@
+"""Timers, histograms and counters for the laser server.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## Each Laser and the server keep a Metrics instance. Histograms are named
+# like 'method.getStatus', 'command.STAT0' or 'lock.wait'; counters like
+# 'timeouts.read'. Metrics.snapshot() returns plain dicts for Pyro, and
+# formatText() renders one or more snapshots in the Prometheus text format,
+# which a local scraper (e.g. the node_exporter textfile collector) can read.
+import bisect
+import contextlib
+import threading
+import time
+
+## Upper bounds of histogram buckets, in seconds.
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+           0.1, 0.2, 0.5, 1., 2., 5., float('inf'))
+
+
+## A histogram of durations with fixed buckets.
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {'buckets': zip(BUCKETS, self.counts), 'count': self.count,
+                'sum': self.sum, 'max': self.max}
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    ## Record a duration in seconds under name.
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    ## Time the body of a with statement under name.
+    @contextlib.contextmanager
+    def timer(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - t0)
+
+    def snapshot(self):
+        with self.lock:
+            return {'histograms': dict((name, h.snapshot())
+                                       for name, h in self.histograms.iteritems()),
+                    'counters': dict(self.counters)}
+
+
+## Render snapshots in the Prometheus text format.
+# snapshots maps a label value (e.g. a laser name) to a Metrics snapshot;
+# metric names are prefixed with 'laser_' and the label is called 'device'.
+def formatText(snapshots):
+    def metricName(name):
+        return 'laser_' + ''.join(c if c.isalnum() else '_' for c in name)
+    lines = []
+    for device, snapshot in sorted(snapshots.iteritems()):
+        for name, value in sorted(snapshot['counters'].iteritems()):
+            lines.append('%s_total{device="%s"} %d'
+                         % (metricName(name), device, value))
+        for name, h in sorted(snapshot['histograms'].iteritems()):
+            base = metricName(name) + '_seconds'
+            cumulative = 0
+            for bound, count in h['buckets']:
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{device="%s",le="%s"} %d'
+                             % (base, device, le, cumulative))
+            lines.append('%s_sum{device="%s"} %r' % (base, device, h['sum']))
+            lines.append('%s_count{device="%s"} %d' % (base, device, h['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,135 @@
+"""Microbenchmark of the per-call cost of laser power queries.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## This script calls query methods directly (no Pyro) on each driver against
+# a simulator with no simulated timing, so that only the driver's own work
+# is measured, e.g.
+#   python microbench.py -n 20000
+# For each method it reports the time per call, its 99th percentile (jitter)
+# and the Python and builtin function calls made per call. Python 2 has no
+# tracemalloc, so builtin calls, which each return a new object (strip,
+# split, join, int ...), stand in for allocations. Where tracemalloc is
+# available (Python 3, or a patched 2.7) the memory allocated per call is
+# reported as well.
+import gc
+import sys
+import time
+
+import benchmark
+import cobolt
+import deepstar
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+## Drivers and simulator URLs to measure.
+DRIVERS = [('cobolt', cobolt.CoboltLaser, 'sim://cobolt?realtime=0', 115200),
+           ('deepstar', deepstar.DeepstarLaser, 'sim://deepstar?realtime=0',
+            9600)]
+## Methods to call, as (name, args).
+METHODS = [('getPower_mW', ()),
+           ('getIsOn', ()),
+           ('setPower_mW', (10,))]
+
+
+## Return (Python calls, builtin calls) made by n calls of func.
+def countCalls(func, n):
+    counts = {'call': 0, 'c_call': 0}
+    def profile(frame, event, arg):
+        if event in counts:
+            counts[event] += 1
+    sys.setprofile(profile)
+    try:
+        for i in xrange(n):
+            func()
+    finally:
+        sys.setprofile(None)
+    return counts['call'], counts['c_call']
+
+
+## Return bytes allocated by n calls of func, or None without tracemalloc.
+def measureMemory(func, n):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for i in xrange(n):
+            func()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    return sum(stat.size_diff for stat in after.compare_to(before, 'filename')
+               if stat.size_diff > 0)
+
+
+## Measure each method of one laser; return a dict of results by method.
+def measure(device, n):
+    results = {}
+    for method, args in METHODS:
+        call = getattr(device, method)
+        func = lambda: call(*args)
+        for i in xrange(100):
+            func()
+        latencies = []
+        gc.collect()
+        for i in xrange(n):
+            t0 = time.time()
+            func()
+            latencies.append(time.time() - t0)
+        latencies.sort()
+        calls, builtins = countCalls(func, 100)
+        memory = measureMemory(func, 100)
+        results[method] = {
+                'us_per_call': 1e6 * sum(latencies) / n,
+                'p99_us': 1e6 * benchmark.percentile(latencies, 99),
+                'python_calls': calls / 100.,
+                'builtin_calls': builtins / 100.,
+                'bytes_per_call': None if memory is None else memory / 100.}
+    return results
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-n", "--calls", type="int", dest="calls", default=5000, help="calls per method", metavar="N")
+    (options, args) = parser.parse_args()
+
+    print "%-10s %-14s %10s %10s %10s %10s %10s" % (
+            'driver', 'method', 'us/call', 'p99 us', 'py calls',
+            'builtins', 'bytes')
+    for name, cls, url, baud in DRIVERS:
+        device = cls(url, baud, 1)
+        try:
+            results = measure(device, options.calls)
+        finally:
+            device.close()
+            device.logger.close()
+        for method, args in METHODS:
+            entry = results[method]
+            print "%-10s %-14s %10.1f %10.1f %10.1f %10.1f %10s" % (
+                    name, method, entry['us_per_call'], entry['p99_us'],
+                    entry['python_calls'], entry['builtin_calls'],
+                    '-' if entry['bytes_per_call'] is None
+                    else '%.0f' % entry['bytes_per_call'])
+
+
+if __name__ == "__main__":
+    main()
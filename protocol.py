@@ -0,0 +1,112 @@
+"""Table-driven serial protocols for Laser classes.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## A driver describes its device's protocol as a table mapping names to
+# Commands, and calls them through laser.Laser.command and commandMany, e.g.
+#   PROTOCOL = {'power': Command('pa?', FLOAT, watts),
+#               'setPower': Command('p %.4f', OK, encode=toWatts)}
+# A Command formats its arguments into the string sent, checks the response
+# against a precompiled pattern and converts it to a value. The pattern must
+# match the whole response; if it has a group, only the group is converted.
+import re
+
+# Common response patterns.
+OK = r'OK'
+FLOAT = r'[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?'
+INT = r'[-+]?[0-9]+'
+BIT = r'[01]'
+
+
+## Raised when a response does not match its command's pattern.
+class ProtocolError(Exception):
+    pass
+
+
+## One command of a device protocol.
+class Command(object):
+    def __init__(self, template, response=None, convert=None, encode=None):
+        # Format string for the command, given the encoded arguments.
+        self.template = template
+        # The expected response, or None to accept anything.
+        self.pattern = response
+        self.response = None
+        if response is not None:
+            self.response = re.compile('(?:%s)$' % response)
+        # Function of the response (or its group) returning the value.
+        self.convert = convert
+        # Function of the arguments returning the tuple to format, or a value.
+        self.encode = encode
+
+
+    ## Return the string to send for args.
+    def format(self, *args):
+        if self.encode is not None:
+            args = self.encode(*args)
+            if not isinstance(args, tuple):
+                args = (args,)
+        if args:
+            return self.template % args
+        return self.template
+
+
+    ## Check a response and return its value.
+    def decode(self, response):
+        if self.response is not None:
+            match = self.response.match(response)
+            if match is None:
+                raise ProtocolError("Unexpected response to %s: %r."
+                                    % (self.template, response))
+            if match.lastindex:
+                response = match.group(1)
+        if self.convert is not None:
+            return self.convert(response)
+        return response
+
+
+## Caches the bytes sent for each command string, made by frame(command),
+# so that repeated commands are only encoded once. The commands in table
+# without arguments are encoded up front; others are cached while the cache
+# is smaller than maxSize.
+class Encoder(object):
+    def __init__(self, frame, table=None, maxSize=1024):
+        self.frame = frame
+        self.maxSize = maxSize
+        self.cache = {}
+        for command in (table or {}).itervalues():
+            if '%' not in command.template:
+                self.encode(command.template)
+
+
+    def encode(self, command):
+        encoded = self.cache.get(command)
+        if encoded is None:
+            encoded = self.frame(command)
+            if len(self.cache) < self.maxSize:
+                self.cache[command] = encoded
+        return encoded
+
+
+## Return frames for a protocol table, by command name: precompiled patterns
+# that find a whole response in a stream, for commands whose response has
+# a fixed shape. name returns the name of a command from its string.
+def frames(table, name):
+    result = {}
+    for command in table.itervalues():
+        if command.pattern is not None:
+            result[name(command.template)] = re.compile(
+                    '(?:%s)' % command.pattern)
+    return result
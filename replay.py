@@ -0,0 +1,147 @@
+"""Replay a laser command journal through a simulated device.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## This script feeds the traffic recorded in a journal (see journal.py) to a
+# port, normally a simulated device, at the original pace or faster, and
+# compares the latency of each transaction with the recorded one, e.g.
+#   python replay.py deepstar405.jnl sim://deepstar --speed 10
+# A transaction is a run of writes followed by the reads of their responses
+# (one command, or several pipelined); its latency runs from the first write
+# to the last byte read.
+import json
+import time
+
+import benchmark
+import journal
+import transport
+
+
+## Group journal records into transactions, as dicts with the time of the
+# first write, the method, the data written, the number of bytes read and
+# the latency.
+def transactions(records):
+    current = None
+    for t, kind, method, data in records:
+        if kind == journal.TX:
+            if current is None or current['rxBytes']:
+                if current is not None:
+                    yield current
+                current = {'time': t, 'method': method, 'tx': [],
+                           'rxBytes': 0, 'latency': None}
+            current['tx'].append(data)
+        elif kind == journal.RX and current is not None:
+            current['rxBytes'] += len(data)
+            current['latency'] = t - current['time']
+    if current is not None:
+        yield current
+
+
+## Send each transaction to port, keeping the recorded spacing divided by
+# speed (or back to back if speed is 0), and read as many bytes as were
+# recorded. Return (method, recorded latency, replayed latency, complete)
+# for each transaction.
+def replay(transactionList, port, speed=1.):
+    results = []
+    if not transactionList:
+        return results
+    t0 = transactionList[0]['time']
+    start = time.time()
+    for transaction in transactionList:
+        if speed:
+            delay = start + (transaction['time'] - t0) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sent = time.time()
+        for data in transaction['tx']:
+            port.write(data)
+        received = 0
+        while received < transaction['rxBytes']:
+            data = port.read(transaction['rxBytes'] - received)
+            if not data:
+                break
+            received += len(data)
+        results.append((transaction['method'], transaction['latency'],
+                        time.time() - sent,
+                        received >= transaction['rxBytes']))
+    return results
+
+
+## Return latency statistics by method, for the recorded and replayed runs.
+def summarise(results):
+    summary = {}
+    for method, recorded, replayed, complete in results:
+        entry = summary.setdefault(method or '-', {
+                'recorded': [], 'replayed': [], 'incomplete': 0})
+        if recorded is not None:
+            entry['recorded'].append(recorded)
+        entry['replayed'].append(replayed)
+        if not complete:
+            entry['incomplete'] += 1
+    for method, entry in summary.iteritems():
+        entry['calls'] = len(entry['replayed'])
+        for key in ('recorded', 'replayed'):
+            latencies = sorted(entry.pop(key))
+            for p in (50, 99):
+                value = benchmark.percentile(latencies, p)
+                entry['%s_p%d_ms' % (key, p)] = (None if value is None
+                                                 else 1000 * value)
+    return summary
+
+
+## Print a summary table.
+def report(summary):
+    def ms(value):
+        return '-' if value is None else '%.2f' % value
+    print "%-20s %7s %11s %11s %11s %11s %10s" % (
+            'method', 'calls', 'rec p50 ms', 'rec p99 ms',
+            'rep p50 ms', 'rep p99 ms', 'incomplete')
+    for method in sorted(summary):
+        entry = summary[method]
+        print "%-20s %7d %11s %11s %11s %11s %10d" % (
+                method, entry['calls'],
+                ms(entry['recorded_p50_ms']), ms(entry['recorded_p99_ms']),
+                ms(entry['replayed_p50_ms']), ms(entry['replayed_p99_ms']),
+                entry['incomplete'])
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] JOURNAL PORT")
+    parser.add_option("-b", "--baud", type="int", dest="baud_rate", default=9600, help="port baud rate in bits/sec", metavar="RATE")
+    parser.add_option("-t", "--timeout", type="float", dest="timeout", default=1., help="read timeout in seconds", metavar="SECONDS")
+    parser.add_option("--speed", type="float", dest="speed", default=1., help="replay this many times faster than recorded; 0 for back to back", metavar="FACTOR")
+    parser.add_option("-o", "--output", dest="output", default=None, help="save the summary as JSON to this file", metavar="FILE")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Give a journal file and a port, e.g. sim://deepstar.")
+
+    transactionList = list(transactions(journal.read(args[0])))
+    port = transport.openPort(args[1], options.baud_rate, options.timeout)
+    try:
+        results = replay(transactionList, port, options.speed)
+    finally:
+        port.close()
+    summary = summarise(results)
+    report(summary)
+    if options.output:
+        with open(options.output, 'w') as fh:
+            json.dump(summary, fh, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Server-side power sequences for Laser classes.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## A sequence is a list of (time, power) points, with times in seconds from
+# the start of the sequence and powers in mW. A Sequencer runs one on its own
+# thread, setting each power at its time, and records when each set actually
+# happened so clients can see the achieved timing.
+import math
+import threading
+import time
+
+# Sleep until this long before a point is due, then spin to hit it.
+SPIN_TIME = 0.002
+
+
+## Return a list of (time, power) points for a simple waveform.
+# shape is one of 'ramp', 'triangle', 'square' or 'sine'; the power moves
+# between low and high mW over duration seconds, repeated cycles times,
+# in steps points per cycle.
+def makeWaveform(shape, low, high, duration, steps=10, cycles=1):
+    steps = int(steps)
+    if steps < 2:
+        raise ValueError('A waveform needs at least two steps.')
+    period = float(duration) / cycles
+    span = high - low
+    points = []
+    for cycle in xrange(int(cycles)):
+        for i in xrange(steps):
+            phase = float(i) / (steps - 1 if shape == 'ramp' else steps)
+            if shape == 'ramp':
+                level = phase
+            elif shape == 'triangle':
+                level = 1 - abs(2 * phase - 1)
+            elif shape == 'square':
+                level = 0 if phase < 0.5 else 1
+            elif shape == 'sine':
+                level = 0.5 - 0.5 * math.cos(2 * math.pi * phase)
+            else:
+                raise ValueError("Unknown waveform shape '%s'." % shape)
+            t = cycle * period + period * float(i) / steps
+            points.append((t, low + span * level))
+    return points
+
+
+## Runs power sequences for one laser.
+class Sequencer(object):
+    def __init__(self, setPower):
+        # The function called with each power in mW.
+        self.setPower = setPower
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.points = []
+        # (requested time, achieved time, set duration) for each point done.
+        self.achieved = []
+        self.startTime = None
+        self.error = None
+
+
+    ## Start running points; stop any sequence already running.
+    def start(self, points, delay=0):
+        points = sorted((float(t), float(mW)) for t, mW in points)
+        if not points:
+            raise ValueError('Empty sequence.')
+        self.stop()
+        self.points = points
+        self.achieved = []
+        self.error = None
+        self.stopEvent.clear()
+        self.startTime = time.time() + delay
+        self.thread = threading.Thread(target=self._run, name='sequencer')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    ## Stop the running sequence, leaving the power at its last value.
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def _run(self):
+        for t, mW in self.points:
+            due = self.startTime + t
+            # Sleep most of the way, so stop() takes effect promptly ...
+            if self.stopEvent.wait(max(due - time.time() - SPIN_TIME, 0)):
+                return
+            # ... then spin for the last few ms.
+            while time.time() < due:
+                pass
+            before = time.time()
+            try:
+                self.setPower(mW)
+            except Exception as e:
+                self.error = str(e)
+                return
+            self.achieved.append((t, before - self.startTime,
+                                  time.time() - before))
+
+
+    ## Return a dict describing progress and achieved timing.
+    # Timing errors are achieved minus requested times, in seconds.
+    def getStatus(self):
+        achieved = list(self.achieved)
+        errors = [a - r for r, a, d in achieved]
+        status = {'running': self.isRunning(),
+                  'done': len(achieved),
+                  'total': len(self.points),
+                  'error': self.error,
+                  'points': [(r, a, d, self.points[i][1])
+                             for i, (r, a, d) in enumerate(achieved)]}
+        if errors:
+            status['meanTimingError'] = sum(errors) / len(errors)
+            status['maxTimingError'] = max(errors, key=abs)
+            status['meanSetDuration'] = sum(
+                    d for r, a, d in achieved) / len(achieved)
+        return status
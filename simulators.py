@@ -0,0 +1,303 @@
+"""Simulated serial devices for testing Laser classes without hardware.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## Simulators are selected through transport.openPort with a port URL of the
+# form sim://<device>?<option>=<value>&..., e.g.
+#   comPort = sim://deepstar?junk=0.1&delay=0.002
+# Options common to all simulators:
+#   delay   - device processing time per command, in seconds;
+#   junk    - probability of junk bytes following a response;
+#   seed    - seed for the random number generator;
+#   realtime - 0 to skip baud-rate and delay timing.
+# The Cobolt simulator also takes efficiency, the measured power as a
+# fraction of the set power, e.g. sim://cobolt?efficiency=0.9.
+import abc
+import random
+import threading
+import time
+
+
+## Open a simulated device; called by transport.openPort.
+def openPort(name, options, baudRate, timeout):
+    try:
+        cls = SIMULATORS[name]
+    except KeyError:
+        raise Exception("No simulator for device '%s'." % name)
+    return cls(baudRate, timeout, **options)
+
+
+## Base class for a simulated serial device.
+# The port looks like a serial.Serial to the driver. Commands are split from
+# the written bytes by the terminator and passed to respond(); responses are
+# made available to read after the time it would take a real device to
+# receive, process and transmit them at the configured baud rate.
+class SimulatedPort(object):
+    __metaclass__ = abc.ABCMeta
+
+    terminator = '\r\n'
+
+    def __init__(self, baudRate, timeout, delay=0.001, junk=0, seed=None,
+                 realtime=1):
+        self.port = 'sim://' + self.__class__.__name__
+        self.baudrate = int(baudRate)
+        self.timeout = timeout
+        self.delay = float(delay)
+        self.junk = float(junk)
+        self.realtime = bool(int(realtime))
+        self.random = random.Random(seed)
+        self.isOpen = True
+        # Bytes written but not yet parsed into a command.
+        self.inBuffer = ''
+        # Pending output as a list of (time available, bytes).
+        self.output = []
+        # Time at which the device finishes its current transmission.
+        self.busyUntil = 0
+        self.condition = threading.Condition()
+
+
+    ## Time to transfer n bytes at the configured baud rate (8N1).
+    def transferTime(self, n):
+        if not self.realtime:
+            return 0
+        return 10. * n / self.baudrate
+
+
+    ## Return the response to a single command, without terminator.
+    # Return None for no response.
+    @abc.abstractmethod
+    def respond(self, command):
+        pass
+
+
+    ## Return some junk bytes to follow a response.
+    def makeJunk(self):
+        return ''.join(chr(self.random.randint(0, 255))
+                       for i in xrange(self.random.randint(1, 4)))
+
+
+    ## Split complete commands from the input buffer.
+    def splitCommands(self):
+        commands = self.inBuffer.split(self.terminator)
+        self.inBuffer = commands.pop()
+        return commands
+
+
+    def write(self, data):
+        if not self.isOpen:
+            raise IOError('Port is closed.')
+        now = time.time()
+        with self.condition:
+            self.inBuffer += data
+            ready = max(now, self.busyUntil) + self.transferTime(len(data))
+            for command in self.splitCommands():
+                response = self.respond(command)
+                if response is None:
+                    continue
+                response += self.terminator
+                if self.junk and self.random.random() < self.junk:
+                    response += self.makeJunk()
+                if self.realtime:
+                    ready += self.delay
+                ready += self.transferTime(len(response))
+                self.output.append((ready, response))
+            self.busyUntil = ready
+            self.condition.notify_all()
+        return len(data)
+
+
+    ## Move output that has arrived by now into a string; leave the rest.
+    def _arrived(self):
+        now = time.time()
+        arrived = []
+        while self.output and self.output[0][0] <= now:
+            arrived.append(self.output.pop(0)[1])
+        return ''.join(arrived)
+
+
+    ## Wait for data that satisfies done(data), or until timeout.
+    # Data not consumed is pushed back to the head of the output.
+    def _readUntil(self, done):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        data = ''
+        with self.condition:
+            while True:
+                data += self._arrived()
+                end = done(data)
+                if end is not None:
+                    break
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    end = len(data)
+                    break
+                wait = None if deadline is None else deadline - now
+                if self.output:
+                    nextTime = self.output[0][0] - now
+                    wait = nextTime if wait is None else min(wait, nextTime)
+                self.condition.wait(max(wait, 0) if wait is not None else None)
+            if data[end:]:
+                self.output.insert(0, (0, data[end:]))
+        return data[:end]
+
+
+    def read(self, size=1):
+        return self._readUntil(lambda data: size if len(data) >= size else None)
+
+
+    ## Read into a bytearray or memoryview, like io.RawIOBase.readinto.
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+    def readline(self):
+        def done(data):
+            i = data.find('\n')
+            return None if i < 0 else i + 1
+        return self._readUntil(done)
+
+
+    def inWaiting(self):
+        with self.condition:
+            now = time.time()
+            return sum(len(r) for t, r in self.output if t <= now)
+
+
+    ## Discard data that has already arrived.
+    def flushInput(self):
+        with self.condition:
+            self._arrived()
+
+
+    def flushOutput(self):
+        pass
+
+
+    def close(self):
+        self.isOpen = False
+
+
+## A simulated Cobolt laser.
+class CoboltSimulator(SimulatedPort):
+    def __init__(self, baudRate, timeout, maxPower=100., serialNumber='12345',
+                 efficiency=1., **kwargs):
+        super(CoboltSimulator, self).__init__(baudRate, timeout, **kwargs)
+        self.maxPower_W = float(maxPower) / 1000.
+        self.serialNumber = serialNumber
+        # Measured power as a fraction of the set power, to model drift.
+        self.efficiency = float(efficiency)
+        self.setPower_W = 0.
+        self.isOn = False
+        self.fault = 0
+        self.hours = 1234.5
+        self.autostart = True
+
+
+    def respond(self, command):
+        command = command.strip()
+        if command.startswith('@cobasp '):
+            self.setPower_W = min(float(command.split()[1]), self.maxPower_W)
+            return 'OK'
+        if command.startswith('@cobas '):
+            self.autostart = command.split()[1] == '1'
+            return 'OK'
+        if command.startswith('p '):
+            self.setPower_W = min(float(command.split()[1]), self.maxPower_W)
+            return 'OK'
+        if command == 'l1':
+            self.isOn = not self.fault
+            return 'OK'
+        if command == 'l0' or command == '@cob0':
+            self.isOn = False
+            return 'OK'
+        if command == 'cf':
+            self.fault = 0
+            return 'OK'
+        if command in ('@cob1', '@cobasdr 0'):
+            return 'OK'
+        if command == 'l?':
+            return '1' if self.isOn else '0'
+        if command == 'p?':
+            return '%.4f' % self.setPower_W
+        if command == 'pa?':
+            if not self.isOn:
+                return '0.0000'
+            return '%.4f' % (self.setPower_W * self.efficiency
+                             * self.random.gauss(1, 0.002))
+        if command == 'gmlp?':
+            return '%.1f' % (self.maxPower_W * 1000)
+        if command == 'sn?':
+            return self.serialNumber
+        if command == 'gfv?':
+            return '5.3'
+        if command == 'f?':
+            return '%d' % self.fault
+        if command == 'hrs?':
+            return '%.2f' % self.hours
+        return 'Syntax error: illegal command'
+
+
+## A simulated DeepStar laser.
+# Commands arrive as 16-byte frames: the command, space-padded to 14 bytes,
+# then CR/LF. Frames of the wrong length are rejected.
+class DeepstarSimulator(SimulatedPort):
+    frameLength = 16
+
+    def __init__(self, baudRate, timeout, maxPower=100, wavelength=488,
+                 serialNumber='12345', **kwargs):
+        super(DeepstarSimulator, self).__init__(baudRate, timeout, **kwargs)
+        self.maxPower = int(maxPower)
+        self.wavelength = int(wavelength)
+        self.serialNumber = serialNumber
+        self.level = 0
+        self.isOn = False
+
+
+    def respond(self, command):
+        if len(command) + len(self.terminator) != self.frameLength:
+            return 'UK'
+        command = command.strip()
+        if command == 'S?':
+            return 'S2' if self.isOn else 'S0'
+        if command == 'LON':
+            self.isOn = True
+            return 'LON'
+        if command == 'LF':
+            self.isOn = False
+            return 'LF'
+        if command in ('L2', 'IPO', 'MF'):
+            return command
+        if command == 'PP?':
+            return 'PP%03X' % self.level
+        if command.startswith('PP'):
+            try:
+                self.level = int(command[2:], 16) & 0xFFF
+            except ValueError:
+                return 'UK'
+            return 'PP%03X' % self.level
+        if command == 'STAT0':
+            # The max. power in mW is the third token.
+            return 'DS%d SN%s %d mW' % (self.wavelength, self.serialNumber,
+                                        self.maxPower)
+        if command in ('STAT1', 'STAT2', 'STAT3'):
+            return '%s OK' % command
+        return 'UK'
+
+
+## Map device names in sim:// URLs to simulator classes.
+SIMULATORS = {'cobolt': CoboltSimulator,
+              'deepstar': DeepstarSimulator}
@@ -0,0 +1,154 @@
+"""Closed-loop power stabilisation for Laser classes.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## A Stabiliser holds measured power at the set point. At a fixed interval
+# it reads the measured power and nudges the power commanded from the
+# device by gain times the error (integral control), keeping the command
+# within maxCorrection (a fraction) of the set point and within the
+# device's maximum. Changing the set point restarts the settling clock; the
+# loop counts as settled once the error has stayed within tolerance (a
+# fraction of the set point) for SETTLE_SAMPLES samples in a row.
+import collections
+import math
+import threading
+import time
+
+# Consecutive samples within tolerance needed to count as settled.
+SETTLE_SAMPLES = 3
+# Samples kept for the residual error.
+RESIDUAL_SAMPLES = 20
+
+
+## Holds one laser's measured power at its set point.
+class Stabiliser(object):
+    def __init__(self, readPower, getTarget, setCommand, maxPower,
+                 interval=1., gain=0.5, maxCorrection=0.2, tolerance=0.01):
+        # readPower() returns the measured power in mW, or 0 if off.
+        self.readPower = readPower
+        # getTarget() returns the set point in mW, or None if unset.
+        self.getTarget = getTarget
+        # setCommand(mW) sets the device power without changing the set point.
+        self.setCommand = setCommand
+        self.maxPower = maxPower
+        self.interval = float(interval)
+        self.gain = float(gain)
+        self.maxCorrection = float(maxCorrection)
+        self.tolerance = float(tolerance)
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.target = None
+        self.command = None
+        self.measured = None
+        self.targetTime = None
+        self.settlingTime = None
+        self.inTolerance = 0
+        self.residuals = collections.deque(maxlen=RESIDUAL_SAMPLES)
+        self.corrections = 0
+        self.saturated = False
+        # Number of failed samples, and the last error.
+        self.errors = 0
+        self.error = None
+
+
+    def start(self):
+        self.stop()
+        self.stopEvent.clear()
+        self.target = None
+        self.thread = threading.Thread(target=self._run, name='stabiliser')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    ## Stop correcting, leaving the last commanded power in place.
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def _run(self):
+        while not self.stopEvent.wait(self.interval):
+            try:
+                self.step()
+            except Exception as e:
+                self.errors += 1
+                self.error = str(e)
+
+
+    ## Take one sample and correct the commanded power.
+    def step(self):
+        target = self.getTarget()
+        if target != self.target:
+            # A new set point: the device was just set to it.
+            self.target = target
+            self.command = target
+            self.targetTime = time.time()
+            self.settlingTime = None
+            self.inTolerance = 0
+            self.residuals.clear()
+        if not target:
+            return
+        measured = self.readPower()
+        self.measured = measured
+        if not measured:
+            # Emission is off; nothing to correct.
+            return
+        error = target - measured
+        self.residuals.append(error)
+        if abs(error) <= self.tolerance * target:
+            self.inTolerance += 1
+            if self.inTolerance == SETTLE_SAMPLES and self.settlingTime is None:
+                self.settlingTime = time.time() - self.targetTime
+            return
+        self.inTolerance = 0
+        low = target * (1 - self.maxCorrection)
+        high = min(target * (1 + self.maxCorrection), self.maxPower())
+        command = self.command + self.gain * error
+        self.saturated = not low <= command <= high
+        command = min(max(command, low), high)
+        if command != self.command:
+            self.setCommand(command)
+            self.command = command
+            self.corrections += 1
+
+
+    ## Return a dict describing the loop: set point, commanded and measured
+    # power, settling time (s from the last set point change, or None if not
+    # yet settled) and residual error (mean and RMS of recent errors, mW).
+    def getStatus(self):
+        residuals = list(self.residuals)
+        status = {'running': self.isRunning(),
+                  'target_mW': self.target,
+                  'command_mW': self.command,
+                  'measured_mW': self.measured,
+                  'settled': self.settlingTime is not None,
+                  'settlingTime': self.settlingTime,
+                  'corrections': self.corrections,
+                  'saturated': self.saturated,
+                  'errors': self.errors,
+                  'error': self.error}
+        if residuals:
+            status['residualMean_mW'] = sum(residuals) / len(residuals)
+            status['residualRMS_mW'] = math.sqrt(
+                    sum(r * r for r in residuals) / len(residuals))
+        return status
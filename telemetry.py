@@ -0,0 +1,189 @@
+"""Time-series telemetry recording for Laser classes.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## A Recorder samples a laser at a fixed interval into preallocated ring
+# buffers and appends each sample to a file of fixed-width little-endian
+# records, with no header, so the file can be memory-mapped directly:
+#   numpy.memmap(filename, dtype=numpy.dtype(telemetry.DTYPE))
+# Windows are returned as {'dtype': DTYPE, 'data': <packed records>}, so a
+# client can do numpy.frombuffer(w['data'], dtype=numpy.dtype(w['dtype'])).
+import array
+import bisect
+import os
+import struct
+import threading
+import time
+
+## Fields of a record, in order, as (name, struct code, numpy type).
+FIELDS = [('time', 'd', '<f8'),
+          ('power_mW', 'f', '<f4'),
+          ('hours', 'f', '<f4'),
+          ('isOn', 'B', 'u1'),
+          ('fault', 'B', 'u1')]
+RECORD = struct.Struct('<' + ''.join(code for name, code, np in FIELDS))
+DTYPE = [(name, np) for name, code, np in FIELDS]
+# Fault value recorded when the device does not report faults.
+NO_FAULT_INFO = 255
+
+
+## Return the default telemetry file for a name, next to the log files.
+def defaultFilename(name):
+    path = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(path, '%s.tel' % name)
+
+
+## Samples one laser into ring buffers and, optionally, a file.
+class Recorder(object):
+    def __init__(self, sample, interval, capacity=36000, filename=None,
+                 flushEvery=10):
+        # sample() returns a dict with the keys of FIELDS except 'time'.
+        self.sample = sample
+        self.interval = float(interval)
+        self.capacity = int(capacity)
+        self.filename = filename
+        self.flushEvery = flushEvery
+        self.buffers = dict((name, array.array(code, [0]) * self.capacity)
+                            for name, code, np in FIELDS)
+        # Next slot to write, and number of valid samples.
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.fh = None
+        self.thread = None
+        self.stopEvent = threading.Event()
+        # Number of failed samples.
+        self.errors = 0
+
+
+    def start(self):
+        if self.filename:
+            self.fh = open(self.filename, 'ab')
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self._run, name='telemetry')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+
+    def _run(self):
+        nextTime = time.time()
+        unflushed = 0
+        while not self.stopEvent.is_set():
+            t = time.time()
+            try:
+                values = self.sample()
+            except Exception:
+                self.errors += 1
+            else:
+                values['time'] = t
+                self.add(values)
+                if self.fh:
+                    self.fh.write(RECORD.pack(*[values[name]
+                                                for name, c, np in FIELDS]))
+                    unflushed += 1
+                    if unflushed >= self.flushEvery:
+                        self.fh.flush()
+                        unflushed = 0
+            # Keep to the sample grid even if a sample was slow.
+            nextTime += self.interval
+            if nextTime < time.time():
+                nextTime = time.time()
+            self.stopEvent.wait(nextTime - time.time())
+        if self.fh:
+            self.fh.flush()
+
+
+    ## Add a sample to the ring buffers.
+    def add(self, values):
+        with self.lock:
+            for name, buf in self.buffers.iteritems():
+                buf[self.head] = values[name]
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+
+    ## Return (oldest time, packed records with start <= time < end) from
+    # the ring buffers. The oldest time is None if the buffers are empty.
+    def _ringRecords(self, start, end):
+        with self.lock:
+            first = (self.head - self.count) % self.capacity
+            capacity = self.capacity
+            count = self.count
+            column = self.buffers['time']
+            # Times in ring order, so we can bisect without copying.
+            class Times(object):
+                def __len__(self):
+                    return count
+                def __getitem__(self, i):
+                    return column[(first + i) % capacity]
+            times = Times()
+            if not count:
+                return None, []
+            lo = bisect.bisect_left(times, start)
+            hi = bisect.bisect_left(times, end)
+            columns = [self.buffers[name] for name, c, np in FIELDS]
+            records = []
+            for i in xrange(lo, hi):
+                j = (first + i) % capacity
+                records.append(RECORD.pack(*[col[j] for col in columns]))
+            return times[0], records
+
+
+    ## Return packed records from the file with start <= time < end.
+    def _fileRecords(self, start, end):
+        if not self.filename or not os.path.exists(self.filename):
+            return ''
+        if self.fh:
+            self.fh.flush()
+        size = RECORD.size
+        with open(self.filename, 'rb') as fh:
+            fh.seek(0, os.SEEK_END)
+            n = fh.tell() // size
+            # Records are in time order, so bisect on the time field.
+            class Times(object):
+                def __len__(self):
+                    return n
+                def __getitem__(self, i):
+                    fh.seek(i * size)
+                    return struct.unpack('<d', fh.read(8))[0]
+            times = Times()
+            lo = bisect.bisect_left(times, start)
+            hi = bisect.bisect_left(times, end)
+            fh.seek(lo * size)
+            return fh.read((hi - lo) * size)
+
+
+    ## Return a window of samples with start <= time < end.
+    # Served from the ring buffers when they cover the window, otherwise
+    # from the file.
+    def getWindow(self, start=0, end=float('inf')):
+        oldest, records = self._ringRecords(start, end)
+        if oldest is not None and (oldest <= start or not self.filename):
+            data = ''.join(records)
+        else:
+            data = self._fileRecords(start, end)
+        return {'dtype': DTYPE, 'data': data}
@@ -0,0 +1,247 @@
+"""Tests of laser comms against simulated devices.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## These tests run the drivers against the simulators (see simulators.py),
+# so they need no hardware:
+#   python -m unittest test_comms
+# Simulated devices take delay s to process each command, which gives the
+# deadline and scheduling tests room to act part-way through a transaction.
+import os
+import threading
+import time
+import unittest
+
+import cobolt
+import deepstar
+import laser
+import protocol
+import simulators
+
+
+class SimulatedLaserTest(unittest.TestCase):
+    def setUp(self):
+        self.lasers = []
+
+    def tearDown(self):
+        for device in self.lasers:
+            device.stopPoller()
+            device.close()
+            device.logger.close()
+            if os.path.exists(device.logger.path):
+                os.remove(device.logger.path)
+
+    ## Return a Cobolt on a simulated port with the given URL options.
+    def cobolt(self, options=''):
+        device = cobolt.CoboltLaser('sim://cobolt?' + options, 115200, 1)
+        self.lasers.append(device)
+        return device
+
+    ## Return a DeepStar on a simulated port with the given URL options.
+    def deepstar(self, options=''):
+        device = deepstar.DeepstarLaser('sim://deepstar?' + options, 9600, 1)
+        self.lasers.append(device)
+        return device
+
+    ## Start func in a thread; return the thread and a list that will hold
+    # its result or exception.
+    def inThread(self, func):
+        result = []
+        def target():
+            try:
+                result.append(func())
+            except Exception as e:
+                result.append(e)
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread, result
+
+
+class DeadlineTest(SimulatedLaserTest):
+    ## getStatus sends five commands, so with 0.2 s per command a 0.3 s
+    # deadline cuts it short with replies still owed.
+    def checkCoboltResync(self, device):
+        device.setPower_mW(20)
+        self.assertRaises(laser.CommsTimeout, device.getStatus, timeout=0.3)
+        self.assertEqual(device.getIsOn(), False)
+        self.assertEqual(device.getSetPower_mW(), 20)
+        self.assertEqual(device.getStatus()[-1],
+                         'Head operating hours: 1234.50')
+
+    def testCoboltResync(self):
+        device = self.cobolt('delay=0.2')
+        self.checkCoboltResync(device)
+        counters = device.getMetrics()['counters']
+        self.assertEqual(counters['discardedResponses'], 1)
+
+    def testCoboltPipelinedResync(self):
+        device = self.cobolt('delay=0.2')
+        device.canPipeline = True
+        self.checkCoboltResync(device)
+        counters = device.getMetrics()['counters']
+        self.assertEqual(counters['discardedResponses'], 4)
+
+    def testDeepstarResync(self):
+        device = self.deepstar('delay=0.2')
+        self.assertRaises(laser.CommsTimeout, device.getStatus, timeout=0.35)
+        self.assertEqual(device.command('state'), 'S0')
+        self.assertEqual(device.getStatus()[1:], ['STAT1 OK', 'STAT2 OK',
+                                                  'STAT3 OK'])
+
+    def testDeadlineIsNotAFailure(self):
+        device = self.cobolt('delay=0.2')
+        for i in xrange(device.maxCommsFailures):
+            self.assertRaises(laser.CommsTimeout, device.getStatus,
+                              timeout=0.1)
+        self.assertFalse(device.degraded)
+
+    def testLockTimeout(self):
+        device = self.deepstar('delay=0.2')
+        thread, result = self.inThread(device.getStatus)
+        time.sleep(0.05)
+        t0 = time.time()
+        self.assertRaises(laser.CommsTimeout, device.getIsOn, timeout=0.1)
+        self.assertLess(time.time() - t0, 0.2)
+        thread.join()
+        self.assertEqual(len(result[0]), 4)
+
+
+class SchedulerTest(SimulatedLaserTest):
+    ## An urgent command pre-empts a sequence between its transactions, and
+    # runs without the sequence's deadline.
+    def testUrgentPreemption(self):
+        device = self.deepstar('delay=0.2')
+        device.enable()
+        thread, result = self.inThread(
+                lambda: device.getStatus(timeout=0.35))
+        time.sleep(0.1)
+        self.assertEqual(device.disable(), 'LF')
+        thread.join()
+        self.assertIsInstance(result[0], laser.CommsTimeout)
+        self.assertEqual(device.getCommsStats()['preemptions'], 1)
+        self.assertFalse(device.getIsOn())
+
+    def testTimedHandoff(self):
+        # A timed wait for the lock is woken as soon as it is released.
+        scheduler = laser.CommandScheduler()
+        scheduler.acquire()
+        thread, result = self.inThread(
+                lambda: (scheduler.acquire(timeout=5), time.time()))
+        time.sleep(0.05)
+        released = time.time()
+        scheduler.release()
+        thread.join()
+        acquired, at = result[0]
+        self.assertTrue(acquired)
+        self.assertLess(at - released, 0.005)
+
+
+class CacheTest(SimulatedLaserTest):
+    def testCoalescing(self):
+        device = self.deepstar('delay=0.05')
+        device.setCacheTTL({'status': 0})
+        threads = [self.inThread(device.getStatus) for i in xrange(4)]
+        for thread, result in threads:
+            thread.join()
+            self.assertEqual(len(result[0]), 4)
+        stats = device.getCacheStats()
+        self.assertEqual(stats['misses'] + stats['coalesced'], 4)
+        self.assertGreater(stats['coalesced'], 0)
+
+    def testCoalescedTimeout(self):
+        device = self.deepstar('delay=0.2')
+        device.setCacheTTL({'status': 0})
+        thread, result = self.inThread(device.getStatus)
+        time.sleep(0.05)
+        t0 = time.time()
+        self.assertRaises(laser.CommsTimeout, device.getStatus, timeout=0.1)
+        self.assertLess(time.time() - t0, 0.2)
+        thread.join()
+        self.assertEqual(len(result[0]), 4)
+
+    def testInvalidation(self):
+        device = self.cobolt()
+        device.setCacheTTL({'isOn': 10})
+        self.assertFalse(device.getIsOn())
+        device.enable()
+        self.assertTrue(device.getIsOn())
+
+
+class SnapshotTest(SimulatedLaserTest):
+    def waitForPoll(self, device):
+        generation = device.snapshotGeneration
+        deadline = time.time() + 2
+        while device.snapshot.get('generation') != generation:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    ## Count commands sent to the device while calling func.
+    def countCommands(self, device, func):
+        def count():
+            return sum(h['count'] for name, h
+                       in device.getMetrics()['histograms'].iteritems()
+                       if name.startswith('command.'))
+        before = count()
+        func()
+        return count() - before
+
+    def testServedFromSnapshot(self):
+        device = self.cobolt()
+        # Long enough that the poller stays idle during the call.
+        device.startPoller(1)
+        self.waitForPoll(device)
+        self.assertEqual(self.countCommands(device, device.getIsOn), 0)
+
+    def testStaleAfterCommand(self):
+        for device in (self.cobolt(), self.deepstar()):
+            device.startPoller(0.5)
+            self.waitForPoll(device)
+            device.enable()
+            self.assertTrue(device.getIsOn())
+            device.setPower_mW(40)
+            self.assertAlmostEqual(device.getPower_mW(), 40, delta=0.5)
+
+    def testEventsDoNotServeSnapshot(self):
+        device = self.cobolt()
+        device.getEvents(0, 0)
+        self.waitForPoll(device)
+        self.assertGreater(self.countCommands(device, device.getIsOn), 0)
+
+
+class FramingTest(SimulatedLaserTest):
+    ## An error response of the wrong shape fails at once, not after the
+    # read timeout, and does not count towards a reconnect.
+    def testUnexpectedLine(self):
+        device = self.deepstar()
+        respond = simulators.DeepstarSimulator.respond
+        device.connection.respond = (lambda command: 'UK'
+                if command.strip() == 'S?' else respond(device.connection,
+                                                        command))
+        for i in xrange(device.maxCommsFailures):
+            t0 = time.time()
+            self.assertRaises(protocol.ProtocolError, device.command, 'state')
+            self.assertLess(time.time() - t0, 0.5)
+        self.assertFalse(device.degraded)
+
+    def testJunk(self):
+        device = self.deepstar('junk=0.5&seed=1')
+        for i in xrange(20):
+            device.setPower_mW(i)
+            self.assertAlmostEqual(device.getSetPower_mW(), i, delta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Serial transports for Laser classes.
+
+Copyright 2026 The laser server contributors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+## This module opens the connection used by a Laser. A plain port name
+# (e.g. com3, /dev/ttyUSB0) opens a serial.Serial; a URL selects another
+# transport by its scheme, e.g. sim://deepstar for a simulated device.
+import serial
+import urlparse
+
+
+## Map URL schemes to the module that opens them. The module must provide
+# openPort(name, options, baudRate, timeout), where name is the part after
+# the scheme and options is a dict from the query string.
+SCHEMES = {'sim': 'simulators'}
+
+
+## Split a port URL into (scheme, name, options).
+def parsePort(port):
+    url = urlparse.urlsplit(port)
+    options = dict(urlparse.parse_qsl(url.query))
+    return url.scheme, url.netloc + url.path, options
+
+
+## Open a connection with read, readline, write, flushInput and close methods.
+# If journal (a journal.Journal) is given, transfers are recorded in it.
+def openPort(port, baudRate, timeout, journal=None):
+    connection = _open(port, baudRate, timeout)
+    if journal is not None:
+        connection = journal.wrap(connection)
+    return connection
+
+
+def _open(port, baudRate, timeout):
+    scheme = port.split('://', 1)[0] if '://' in port else None
+    if scheme in SCHEMES:
+        scheme, name, options = parsePort(port)
+        module = __import__(SCHEMES[scheme])
+        return module.openPort(name, options, baudRate, timeout)
+    if scheme is not None:
+        # Let pyserial handle its own URLs (loop://, socket://, rfc2217://).
+        return serial.serial_for_url(port, baudrate=baudRate, timeout=timeout)
+    return serial.Serial(port=port,
+            baudrate=baudRate, timeout=timeout,
+            stopbits=serial.STOPBITS_ONE,
+            bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE)